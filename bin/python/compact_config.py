@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import posixpath
+import re
+import stat
+
+# characters that make a file_contexts spec a regex (spec_hasMetaChars() of
+# libselinux), '\' escapes the next character
+META_CHARS = '.^$?*+|[({'
+REGEX_CHARS = META_CHARS + ')]}\\'
+
+# file type field of file_contexts -> S_IFMT
+FILE_TYPES = {'--': stat.S_IFREG, '-d': stat.S_IFDIR, '-c': stat.S_IFCHR, '-b': stat.S_IFBLK,
+              '-s': stat.S_IFSOCK, '-p': stat.S_IFIFO, '-l': stat.S_IFLNK}
+TYPE_FIELDS = {file_type: field for field, file_type in FILE_TYPES.items()}
+
+ANY = object()  # label of a path no rule has to give a particular label
+
+
+def escape(path):
+  return ''.join('\\' + char if char in REGEX_CHARS else char for char in path)
+
+
+def unescape(spec):
+  return re.sub(r'\\(.)', r'\1', spec)
+
+
+def has_meta_chars(spec):
+  return re.search(r'(?<!\\)(?:\\\\)*[' + re.escape(META_CHARS) + ']', spec) is not None
+
+
+def literal_prefix(spec):
+  # Longest literal start of every path the regex can match
+  if '|' in spec:
+    return ''
+  prefix = []
+  chars = iter(spec)
+  for char in chars:
+    if char == '\\':
+      prefix.append(next(chars, ''))
+    elif char in META_CHARS:
+      if char in '?*{' and prefix:
+        prefix.pop()  # makes the character before it optional
+      break
+    else:
+      prefix.append(char)
+  return ''.join(prefix)
+
+
+def read_lines(file_name):
+  # Rule lines of a file_contexts or fs_config file, without blanks and comments
+  with open(file_name) as file:
+    lines = [line.strip() for line in file]
+  return [line for line in lines if line and not line.startswith('#')]
+
+
+class LabelRules():
+  """
+  Path -> label rules resolved like selabel_lookup() of libselinux: specs
+  are regexes anchored at both ends, specs without meta characters (plain
+  paths) are tried before any regex and among each kind the last matching
+  line wins. Regexes are bucketed by their literal prefix so that a lookup
+  only tries the few that can match.
+  """
+
+  def __init__(self, rules):
+    self.exact = collections.defaultdict(list)  # path -> [(file_type, label), ...]
+    self.regexes = collections.defaultdict(list)  # literal prefix -> [(line, regex, file_type, label), ...]
+
+    for line, (spec, file_type, label) in enumerate(rules):
+      if not has_meta_chars(spec):
+        self.exact[unescape(spec)].append((file_type, label))
+        continue
+      try:
+        regex = re.compile(spec)
+      except re.error as e:
+        raise ValueError("Bad regex {0!r:s}: {1!s:s}".format(spec, e))
+      self.regexes[literal_prefix(spec)].append((line, regex, file_type, label))
+
+    self.prefix_lengths = sorted(set(len(prefix) for prefix in self.regexes))
+
+  @classmethod
+  def from_file_contexts(cls, lines):
+    # "<spec> [<file type>] <context>", ext4_info leaves the context of
+    # entries without security.selinux empty
+    rules = []
+    for line in lines:
+      fields = line.split()
+      if len(fields) == 1:
+        rules.append((fields[0], 0, ''))
+      elif len(fields) == 2:
+        rules.append((fields[0], 0, fields[1]))
+      elif len(fields) == 3 and fields[1] in FILE_TYPES:
+        rules.append((fields[0], FILE_TYPES[fields[1]], fields[2]))
+      else:
+        raise ValueError("Bad file_contexts line: {0!r:s}".format(line))
+    return cls(rules)
+
+  @classmethod
+  def from_fs_config(cls, lines):
+    # "<path> <uid> <gid> <mode> [capabilities=...]", paths relative to the
+    # image root ('/' itself aside) and never regexes
+    rules = []
+    for line in lines:
+      path, _, label = line.partition(' ')
+      if not label:
+        raise ValueError("Bad fs_config line: {0!r:s}".format(line))
+      rules.append((escape(fs_config_path(path)), 0, ' '.join(label.split())))
+    return cls(rules)
+
+  @classmethod
+  def from_compact_fs_config(cls, lines):
+    # "<spec> [<file type>] <uid> <gid> <mode> [capabilities=...]", as
+    # written by compact_fs_config()
+    rules = []
+    for line in lines:
+      spec, _, label = line.partition(' ')
+      field, _, typed_label = label.partition(' ')
+      if not label:
+        raise ValueError("Bad fs_config line: {0!r:s}".format(line))
+      if field in FILE_TYPES:
+        rules.append((spec, FILE_TYPES[field], typed_label))
+      else:
+        rules.append((spec, 0, label))
+    return cls(rules)
+
+  def paths(self):
+    # the plain paths of the rules, with their parent directories
+    return ancestors(self.exact)
+
+  def lookup(self, path, mode=0):
+    file_type = stat.S_IFMT(mode or 0)
+
+    for rule_type, label in reversed(self.exact.get(path, ())):
+      if not file_type or not rule_type or rule_type == file_type:
+        return label
+
+    candidates = []
+    for length in self.prefix_lengths:
+      if length > len(path):
+        break
+      candidates.extend(self.regexes.get(path[:length], ()))
+
+    for _, regex, rule_type, label in sorted(candidates, key=lambda rule: rule[0], reverse=True):
+      if (not file_type or not rule_type or rule_type == file_type) and regex.fullmatch(path):
+        return label
+
+    return None
+
+
+def fs_config_path(path):
+  return path if path == '/' else '/' + path
+
+
+def ancestors(paths):
+  closure = set(paths)
+  for path in paths:
+    while path != '/':
+      path = posixpath.dirname(path)
+      if path in closure:
+        break
+      closure.add(path)
+  return closure
+
+
+def compact(labels):
+  """
+  Fewest rules giving each path of labels (path -> label, None for a path
+  that no rule may match) its label: '<dir>(/.*)?' rules that label a
+  directory and everything below it, plus plain path exceptions (the only
+  rules given an empty label, that of entries without a context). Returns
+  [(spec, label), ...], subtree rules first, parents before children.
+
+  The directory tree is solved bottom-up: for every directory and every
+  label it can inherit from a rule above it, the cost is the number of
+  rules needed below, either without a rule of its own or with the best
+  subtree rule. Labels that appear nowhere below a directory all cost the
+  same, so each directory keeps one 'other' cost plus those of its labels.
+  """
+  labels = dict(labels)
+  for path in ancestors(labels):
+    labels.setdefault(path, ANY)
+
+  children = collections.defaultdict(list)
+  for path in labels:
+    if path != '/':
+      children[posixpath.dirname(path)].append(path)
+
+  forbidden = len(labels) + 1  # more than the rules of any valid answer
+  other = object()
+
+  def own(label, inherited):
+    if label is ANY or label == inherited:
+      return 0
+    return forbidden if label is None else 1
+
+  costs = {}  # path -> (cost of 'other', {inherited label: cost})
+  subtree = {}  # path -> (cost, label) of the best rule on the directory
+
+  for path in sorted(labels, key=lambda path: 0 if path == '/' else path.count('/'), reverse=True):
+    label = labels[path]
+    base = 0
+    delta = {}
+    for child in children.get(path, ()):
+      child_other, child_costs = costs[child]
+      base += child_other
+      for inherited, cost in child_costs.items():
+        delta[inherited] = delta.get(inherited, 0) + cost - child_other
+
+    keys = set(delta)
+    if label is not ANY:
+      keys.add(label)
+
+    best = (forbidden * (len(labels) + 1), None)
+    for inherited in sorted(keys - {None, ''}, key=lambda key: (key != label, key)):
+      cost = 1 + own(label, inherited) + base + delta.get(inherited, 0)
+      if cost < best[0]:
+        best = (cost, inherited)
+    subtree[path] = best
+
+    other_cost = min(own(label, other) + base, best[0])
+    path_costs = {}
+    for inherited in keys:
+      cost = min(own(label, inherited) + base + delta.get(inherited, 0), best[0])
+      if cost != other_cost:
+        path_costs[inherited] = cost
+    costs[path] = (other_cost, path_costs)
+
+  rules = []
+  exceptions = []
+  stack = [('/', None)]
+  while stack:
+    path, inherited = stack.pop()
+    label = labels[path]
+
+    below = 0
+    for child in children.get(path, ()):
+      child_other, child_costs = costs[child]
+      below += child_costs.get(inherited, child_other)
+
+    cost, rule_label = subtree[path]
+    if cost < own(label, inherited) + below:
+      rules.append(('/.*' if path == '/' else escape(path) + '(/.*)?', rule_label))
+      inherited = rule_label
+    if own(label, inherited):
+      exceptions.append((escape(path), label))
+
+    stack.extend((child, inherited) for child in children.get(path, ()))
+
+  rules.sort(key=lambda rule: (rule[0].count('/'), rule[0]))
+  exceptions.sort()
+  return rules + exceptions
+
+
+def verify(expected, rules, modes):
+  """
+  [(path, expected label, label given by rules), ...] of the paths of
+  expected (path -> label) that rules do not label the same way
+  """
+  return [(path, label, rules.lookup(path, modes.get(path)))
+          for path, label in sorted(expected.items())
+          if label is not ANY and rules.lookup(path, modes.get(path)) != label]
+
+
+def compact_file_contexts(lines, modes=None, extra_lines=()):
+  """
+  Compacted lines of a file_contexts that still give every path of modes
+  (path -> st_mode, defaults to the plain paths of lines and their parents)
+  the context it gets from lines followed by extra_lines, the way
+  e2fsdroid reads several -S files. The compacted file has to be read
+  after extra_lines instead, so that its subtree rules take precedence
+  over their regexes. Raises ValueError if it doesn't label every path
+  the same.
+  """
+  original = LabelRules.from_file_contexts(list(lines) + list(extra_lines))
+  if modes is None:
+    modes = dict.fromkeys(LabelRules.from_file_contexts(lines).paths(), 0)
+  expected = {path: original.lookup(path, mode) for path, mode in modes.items()}
+
+  compacted = ['{0:s} {1:s}'.format(*rule) for rule in compact(expected)]
+  mismatches = verify(expected, LabelRules.from_file_contexts(list(extra_lines) + compacted), modes)
+  if mismatches:
+    raise ValueError("{0:d} paths labelled differently, first: {1!r:s}".format(
+      len(mismatches), mismatches[0]))
+
+  return compacted
+
+
+def compact_fs_config(lines, modes=None):
+  """
+  Compacted lines of an fs_config, in file_contexts syntax with the
+  'uid gid mode' as label: the canned fs_config of e2fsdroid only takes
+  plain paths, so this is a summary of it that expand_fs_config() turns
+  back into one. With modes (path -> st_mode of the paths to configure,
+  defaults to the plain paths of lines), the rules are made for each file
+  type apart and carry its field, so that the paths modes adds to lines
+  only get the config of entries of their type. Raises ValueError if it
+  doesn't configure every path of lines in modes the same.
+  """
+  original = LabelRules.from_fs_config(lines)
+  configured = {path: labels[-1][1] for path, labels in original.exact.items()}
+  if modes is None:
+    modes = dict.fromkeys(configured, 0)
+
+  compacted = []
+  for file_type in sorted(set(stat.S_IFMT(mode) for mode in modes.values())):
+    labels = {path: configured.get(path, ANY) for path, mode in modes.items()
+              if stat.S_IFMT(mode) == file_type}
+    field = ' ' + TYPE_FIELDS[file_type] if file_type else ''
+    compacted.extend('{0:s}{1:s} {2:s}'.format(spec, field, label) for spec, label in compact(labels))
+
+  expected = {path: configured.get(path, ANY) for path in modes}
+  mismatches = verify(expected, LabelRules.from_compact_fs_config(compacted), modes)
+  if mismatches:
+    raise ValueError("{0:d} paths configured differently, first: {1!r:s}".format(
+      len(mismatches), mismatches[0]))
+
+  return compacted
+
+
+def expand_fs_config(lines, modes):
+  # fs_config lines of the paths of modes (path -> st_mode, '/'-rooted)
+  # from compacted lines, without the paths no rule of their type covers
+  rules = LabelRules.from_compact_fs_config(lines)
+  expanded = []
+  for path, mode in sorted(modes.items()):
+    label = rules.lookup(path, mode)
+    if label is not None:
+      expanded.append('{0:s} {1:s}'.format(path if path == '/' else path[1:], label))
+  return expanded
+
+
+def parser():
+  parser = argparse.ArgumentParser(
+    description='Fold a file_contexts or fs_config into subtree rules plus exceptions')
+  parser.add_argument('input', help='file_contexts or fs_config')
+  parser.add_argument('output', help='Compacted file')
+  parser.add_argument('-c', '--fs-config', dest='fs_config', action='store_true',
+                      help='Input is an fs_config')
+  parser.add_argument('-S', dest='extra', action='append', default=[],
+                      help='file_contexts read after the input (e.g. plat_file_contexts), '
+                           'the compacted file replaces the input and is read after them')
+  return parser
+
+
+if __name__ == '__main__':
+  args = parser().parse_args()
+  lines = read_lines(args.input)
+  if args.fs_config:
+    compacted = compact_fs_config(lines)
+  else:
+    extra_lines = [line for extra in args.extra for line in read_lines(extra)]
+    compacted = compact_file_contexts(lines, extra_lines=extra_lines)
+
+  with open(args.output, 'w') as file:
+    for line in compacted:
+      file.write(line + '\n')
+  print(f'{len(lines)} -> {len(compacted)} rules, verified')
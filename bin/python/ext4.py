@@ -1,8 +1,16 @@
+import array
+import bisect
+import collections
 import ctypes
+import errno
 import functools
 import io
 import math
+import mmap
+import os
 import queue
+import struct
+import threading
 
 
 def wcscmp(str_a, str_b):
@@ -15,6 +23,60 @@ def wcscmp(str_a, str_b):
   return -1 if tmp < 0 else 1 if tmp > 0 else 0
 
 
+# Kernel copy primitives, disabled at the first call the platform rejects.
+# Only errors saying the call itself is unsupported do that; errors about
+# the descriptors or offsets of one call (EBADF, EINVAL, ...) are raised.
+# ENOTSOCK is sendfile() of a platform that only writes to sockets.
+_copy_file_range = getattr(os, "copy_file_range", None)
+_sendfile = getattr(os, "sendfile", None)
+_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK)
+
+
+def copy_fd_range(src_fd, src_offset, dst_fd, dst_offset, byte_len):
+  # Copy byte_len bytes between file descriptors at explicit offsets, using
+  # os.copy_file_range, then os.sendfile, then pread/pwrite as fallbacks
+  global _copy_file_range, _sendfile
+
+  while byte_len > 0:
+    copied = None
+
+    if _copy_file_range is not None:
+      try:
+        copied = _copy_file_range(
+          src_fd, dst_fd, byte_len, src_offset, dst_offset)
+      except OSError as e:
+        if e.errno not in _COPY_UNSUPPORTED:
+          raise
+        _copy_file_range = None
+
+    if copied is None and _sendfile is not None:
+      try:
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        copied = _sendfile(dst_fd, src_fd, src_offset, byte_len)
+      except OSError as e:
+        if e.errno not in _COPY_UNSUPPORTED:
+          raise
+        _sendfile = None
+
+    if copied is None and hasattr(os, "pread"):
+      data = os.pread(src_fd, min(byte_len, Inode.CHUNK_SIZE), src_offset)
+      copied = os.pwrite(dst_fd, data, dst_offset) if data else 0
+
+    if copied is None:
+      os.lseek(src_fd, src_offset, os.SEEK_SET)
+      data = os.read(src_fd, min(byte_len, Inode.CHUNK_SIZE))
+      os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+      copied = os.write(dst_fd, data)
+
+    if copied == 0:
+      raise EndOfStreamError(
+        "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len))
+
+    src_offset += copied
+    dst_offset += copied
+    byte_len -= copied
+
+
 class Ext4Error(Exception):
   pass
 
@@ -34,6 +96,20 @@ class MagicError(Ext4Error):
 # ----------------------------- LOW LEVEL ------------------------------
 
 class ext4_struct(ctypes.LittleEndianStructure):
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+
+    # Precompiled accessors for combined *_lo/*_hi fields, so hot fields such
+    # as i_size don't go through __getattr__ and its exception handling
+    fields = dict(cls.__dict__.get("_fields_", ()))
+    for name, field_type in fields.items():
+      if name.endswith("_lo") and name[:-3] + "_hi" in fields:
+        setattr(cls, name[:-3], ext4_struct._combined_field(
+          name, name[:-3] + "_hi", 8 * ctypes.sizeof(field_type)))
+
+  def _combined_field(lo_name, hi_name, shift):
+    return property(lambda self: (getattr(self, hi_name) << shift) | getattr(self, lo_name))
+
   def __getattr__(self, name):
     try:
       # Combining *_lo and *_hi fields
@@ -77,7 +153,34 @@ class ext4_dir_entry_2(ext4_struct):
     return struct
 
 
+class ext4_dx_root_info(ext4_struct):
+  _fields_ = [
+    ("reserved_zero", ctypes.c_uint),  # 0x0
+    ("hash_version", ctypes.c_ubyte),  # 0x4
+    ("info_length", ctypes.c_ubyte),  # 0x5, Must be 0x8
+    ("indirect_levels", ctypes.c_ubyte),  # 0x6
+    ("unused_flags", ctypes.c_ubyte)  # 0x7
+  ]
+
+
+class ext4_dx_countlimit(ext4_struct):
+  _fields_ = [
+    ("limit", ctypes.c_ushort),  # 0x0
+    ("count", ctypes.c_ushort)  # 0x2
+  ]
+
+
+class ext4_dx_entry(ext4_struct):
+  _fields_ = [
+    ("hash", ctypes.c_uint),  # 0x0, Overlaid by ext4_dx_countlimit in the first entry
+    ("block", ctypes.c_uint)  # 0x4
+  ]
+
+
 class ext4_extent(ext4_struct):
+  # ee_len above this marks an unwritten extent of (ee_len - EXT_INIT_MAX_LEN) blocks
+  EXT_INIT_MAX_LEN = 0x8000
+
   _fields_ = [
     ("ee_block", ctypes.c_uint),  # 0x0000
     ("ee_len", ctypes.c_ushort),  # 0x0004
@@ -134,8 +237,11 @@ class ext4_group_descriptor(ext4_struct):
     ("bg_reserved", ctypes.c_uint),  # 0x003C
   ]
 
-  def _from_buffer_copy(raw, platform64=True):
-    struct = ext4_group_descriptor.from_buffer_copy(raw)
+  # bg_flags
+  EXT4_BG_INODE_UNINIT = 0x1  # Inode table and bitmap are not initialized
+
+  def _from_buffer_copy(raw, offset=0, platform64=True):
+    struct = ext4_group_descriptor.from_buffer_copy(raw, offset)
 
     if not platform64:
       struct.bg_block_bitmap_hi = 0
@@ -232,6 +338,14 @@ class ext4_superblock(ext4_struct):
   # Default value for s_desc_size, if INCOMPAT_64BIT is not set (NEEDS CONFIRMATION)
   EXT2_DESC_SIZE = 0x20
 
+  # s_feature_ro_compat
+  RO_COMPAT_GDT_CSUM = 0x10  # Group descriptors have checksums (bg_itable_unused is valid)
+  RO_COMPAT_METADATA_CSUM = 0x400  # Metadata checksumming (implies the above)
+
+  # s_flags
+  EXT2_FLAGS_SIGNED_HASH = 0x1  # Signed directory hash in use
+  EXT2_FLAGS_UNSIGNED_HASH = 0x2  # Unsigned directory hash in use
+
   # s_feature_incompat
   # Uses 64-bit features (e.g. *_hi structure fields in ext4_group_descriptor)
   INCOMPAT_64BIT = 0x80
@@ -398,7 +512,7 @@ class ext4_xattr_entry(ext4_struct):
 
   def _from_buffer_copy(raw, offset=0, platform64=True):
     struct = ext4_xattr_entry.from_buffer_copy(raw, offset)
-    struct.e_name = raw[offset + 0x10: offset + 0x10 + struct.e_name_len]
+    struct.e_name = bytes(raw[offset + 0x10: offset + 0x10 + struct.e_name_len])
     return struct
 
   @property
@@ -435,9 +549,135 @@ class InodeType:
   CHECKSUM = 0xDE  # Checksum entry; not really a file type, but a type of directory entry
 
 
+class DxHash:
+  LEGACY = 0x0
+  HALF_MD4 = 0x1
+  TEA = 0x2
+  LEGACY_UNSIGNED = 0x3
+  HALF_MD4_UNSIGNED = 0x4
+  TEA_UNSIGNED = 0x5
+  SIPHASH = 0x6  # Casefolded directories only, not supported
+
+  HTREE_EOF_32BIT = 0x7FFFFFFF
+
+
+def _str2hashbuf(msg, length, num, signed):
+  # Pack up to num * 4 bytes of msg into num 32-bit words, padded with length
+  pad = (length | (length << 8)) & 0xFFFFFFFF
+  pad = (pad | (pad << 16)) & 0xFFFFFFFF
+  val = pad
+  buf = []
+
+  for i in range(min(length, num * 4)):
+    c = msg[i] - 0x100 if signed and msg[i] >= 0x80 else msg[i]
+    val = (c + (val << 8)) & 0xFFFFFFFF
+    if i % 4 == 3:
+      buf.append(val)
+      val = pad
+      num -= 1
+
+  if num > 0:
+    buf.append(val)
+    num -= 1
+  buf.extend([pad] * num)
+  return buf
+
+
+def _dx_hack_hash(name, signed):
+  hash0, hash1 = 0x12A3FE2D, 0x37ABE8F9
+
+  for c in name:
+    c = c - 0x100 if signed and c >= 0x80 else c
+    hash = (hash1 + (hash0 ^ ((c * 7152373) & 0xFFFFFFFF))) & 0xFFFFFFFF
+    if hash & 0x80000000:
+      hash = (hash - 0x7FFFFFFF) & 0xFFFFFFFF
+    hash1 = hash0
+    hash0 = hash
+
+  return (hash0 << 1) & 0xFFFFFFFF
+
+
+def _half_md4_transform(buf, data):
+  def rol32(x, s): return ((x << s) | (x >> (32 - s))) & 0xFFFFFFFF
+  def f(x, y, z): return z ^ (x & (y ^ z))
+  def g(x, y, z): return ((x & y) + ((x ^ y) & z)) & 0xFFFFFFFF
+  def h(x, y, z): return x ^ y ^ z
+
+  a, b, c, d = buf
+  # (round function, constant, [(word, shift)] for the a, d, c, b rotation)
+  for fn, k, steps in (
+      (f, 0, ((0, 3), (1, 7), (2, 11), (3, 19), (4, 3), (5, 7), (6, 11), (7, 19))),
+      (g, 0o13240474631, ((1, 3), (3, 5), (5, 9), (7, 13), (0, 3), (2, 5), (4, 9), (6, 13))),
+      (h, 0o15666365641, ((3, 3), (7, 9), (2, 11), (6, 15), (1, 3), (5, 9), (0, 11), (4, 15)))):
+    for i, (word, shift) in enumerate(steps):
+      x = data[word] + k
+      if i % 4 == 0:
+        a = rol32((a + fn(b, c, d) + x) & 0xFFFFFFFF, shift)
+      elif i % 4 == 1:
+        d = rol32((d + fn(a, b, c) + x) & 0xFFFFFFFF, shift)
+      elif i % 4 == 2:
+        c = rol32((c + fn(d, a, b) + x) & 0xFFFFFFFF, shift)
+      else:
+        b = rol32((b + fn(c, d, a) + x) & 0xFFFFFFFF, shift)
+
+  buf[0] = (buf[0] + a) & 0xFFFFFFFF
+  buf[1] = (buf[1] + b) & 0xFFFFFFFF
+  buf[2] = (buf[2] + c) & 0xFFFFFFFF
+  buf[3] = (buf[3] + d) & 0xFFFFFFFF
+
+
+def _tea_transform(buf, data):
+  total = 0
+  b0, b1 = buf[0], buf[1]
+  a, b, c, d = data
+
+  for _ in range(16):
+    total = (total + 0x9E3779B9) & 0xFFFFFFFF
+    b0 = (b0 + ((((b1 << 4) + a) ^ (b1 + total) ^ ((b1 >> 5) + b)) & 0xFFFFFFFF)) & 0xFFFFFFFF
+    b1 = (b1 + ((((b0 << 4) + c) ^ (b0 + total) ^ ((b0 >> 5) + d)) & 0xFFFFFFFF)) & 0xFFFFFFFF
+
+  buf[0] = (buf[0] + b0) & 0xFFFFFFFF
+  buf[1] = (buf[1] + b1) & 0xFFFFFFFF
+
+
+def ext4_dirhash(name, hash_version, seed=None):
+  # Directory index hash of name (bytes), as (major, minor) like ext4fs_dirhash
+  buf = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+  if seed is not None and any(seed):
+    buf = list(seed)
+
+  signed = hash_version in (DxHash.LEGACY, DxHash.HALF_MD4, DxHash.TEA)
+  minor_hash = 0
+
+  if hash_version in (DxHash.LEGACY, DxHash.LEGACY_UNSIGNED):
+    hash = _dx_hack_hash(name, signed)
+  elif hash_version in (DxHash.HALF_MD4, DxHash.HALF_MD4_UNSIGNED):
+    for p in range(0, len(name), 32):
+      _half_md4_transform(buf, _str2hashbuf(
+        name[p:], len(name) - p, 8, signed))
+    hash = buf[1]
+    minor_hash = buf[2]
+  elif hash_version in (DxHash.TEA, DxHash.TEA_UNSIGNED):
+    for p in range(0, len(name), 16):
+      _tea_transform(buf, _str2hashbuf(name[p:], len(name) - p, 4, signed))
+    hash = buf[0]
+    minor_hash = buf[1]
+  else:
+    raise Ext4Error(
+      "Unsupported directory hash version {hash_version:d}".format(hash_version=hash_version))
+
+  hash &= ~1
+  if hash == DxHash.HTREE_EOF_32BIT << 1:
+    hash = (DxHash.HTREE_EOF_32BIT - 1) << 1
+
+  return (hash, minor_hash)
+
+
 # ----------------------------- HIGH LEVEL ------------------------------
 
 class MappingEntry:
+  __slots__ = ("file_block_idx", "disk_block_idx", "block_count")
+
   def __init__(self, file_block_idx, disk_block_idx, block_count=1):
     self.file_block_idx = file_block_idx
     self.disk_block_idx = disk_block_idx
@@ -473,27 +713,116 @@ class MappingEntry:
   def optimize(entries):
     entries.sort(key=lambda entry: entry.file_block_idx)
 
-    idx = 0
-    while idx < len(entries):
-      while idx + 1 < len(entries) \
-          and entries[idx].file_block_idx + entries[idx].block_count == entries[idx + 1].file_block_idx \
-          and entries[idx].disk_block_idx + entries[idx].block_count == entries[idx + 1].disk_block_idx:
-        tmp = entries.pop(idx + 1)
-        entries[idx].block_count += tmp.block_count
+    # Stitch together adjacent entries in one linear pass
+    result = []
+    for entry in entries:
+      if result \
+          and result[-1].file_block_idx + result[-1].block_count == entry.file_block_idx \
+          and result[-1].disk_block_idx + result[-1].block_count == entry.disk_block_idx:
+        result[-1].block_count += entry.block_count
+      else:
+        result.append(entry)
+
+    entries[:] = result
+
+
+class LRUCache:
+  # Bounded mapping evicting the least recently used entry, with hit/miss
+  # counters; safe to share between threads
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __repr__(self):
+    return "{type_name:s}(maxsize = {maxsize!r:s}, size = {size!r:s}, hits = {hits!r:s}, misses = {misses!r:s})".format(
+      hits=self.hits,
+      maxsize=self.maxsize,
+      misses=self.misses,
+      size=len(self.entries),
+      type_name=type(self).__name__
+    )
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      try:
+        value = self.entries[key]
+      except KeyError:
+        self.misses += 1
+        return default
 
-      idx += 1
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+
+      if len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
 
 
 class Volume:
   ROOT_INODE = 2
 
-  def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False):
+  # Default capacity of the decoded inode, directory entry and xattr block caches
+  INODE_CACHE_SIZE = 4096
+  DENTRY_CACHE_SIZE = 65536
+  XATTR_CACHE_SIZE = 1024
+
+  # Longest xattr value shared through intern_xattr_value()
+  XATTR_INTERN_SIZE = 256
+
+  def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False, use_mmap=False):
     self.ignore_flags = ignore_flags
     self.ignore_magic = ignore_magic
     self.offset = offset
     self.platform64 = True  # Initial value needed for Volume.read_struct
     self.stream = stream
 
+    # Memory mapped image: reads are memoryview slices of the mapping and
+    # plain structures are decoded in place, without any syscall per read.
+    # ACCESS_COPY gives a private writable mapping, which ctypes needs for
+    # from_buffer(); nothing is ever written back to the image. Streams that
+    # can't be mapped (pipes, special files, images larger than the address
+    # space) are read with pread instead.
+    self.mmap = None
+    self.view = None
+    if use_mmap:
+      try:
+        self.mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_COPY)
+      except (AttributeError, OSError, ValueError, OverflowError):
+        self.mmap = None
+      else:
+        self.view = memoryview(self.mmap)
+
+    # Positional reads (os.pread) share no stream cursor, so several threads
+    # can read through one Volume; streams without a file descriptor (or
+    # platforms without pread) fall back to seek + read under a lock
+    self.fd = None
+    if hasattr(os, "pread"):
+      try:
+        self.fd = stream.fileno()
+      except (AttributeError, OSError):
+        pass
+    self.lock = threading.Lock()
+
     # Superblock
     self.superblock = self.read_struct(ext4_superblock, 0x400)
     self.platform64 = (self.superblock.s_feature_incompat &
@@ -507,13 +836,52 @@ class Volume:
     self.group_descriptors = [
       None] * (self.superblock.s_inodes_count // self.superblock.s_inodes_per_group)
 
-    # First block after superblock
+    # First block after superblock, the whole table is fetched with one read
+    # (padded so the last descriptor can be decoded with its 64-bit fields)
     group_desc_table_offset = (0x400 // self.block_size + 1) * self.block_size
+    group_desc_table = self.read(group_desc_table_offset,
+                                 len(self.group_descriptors) * self.superblock.s_desc_size +
+                                 max(0, ctypes.sizeof(ext4_group_descriptor) - self.superblock.s_desc_size))
     for group_desc_idx in range(len(self.group_descriptors)):
-      group_desc_offset = group_desc_table_offset + \
-        group_desc_idx * self.superblock.s_desc_size
-      self.group_descriptors[group_desc_idx] = self.read_struct(
-        ext4_group_descriptor, group_desc_offset)
+      self.group_descriptors[group_desc_idx] = ext4_group_descriptor._from_buffer_copy(
+        group_desc_table, group_desc_idx * self.superblock.s_desc_size, platform64=self.platform64)
+
+    # Inode tables loaded in bulk by load_inode_tables(), by group index
+    self.inode_tables = {}
+
+    # (inode_idx, file_type) -> Inode
+    self.inode_cache = LRUCache(Volume.INODE_CACHE_SIZE)
+    # (parent inode_idx, name) -> (inode_idx, file_type), (None, None) if missing
+    self.dentry_cache = LRUCache(Volume.DENTRY_CACHE_SIZE)
+    # xattr block number -> ((name, value), ...)
+    self.xattr_block_cache = LRUCache(Volume.XATTR_CACHE_SIZE)
+    # Distinct short xattr values (SELinux contexts), see intern_xattr_value()
+    self.xattr_values = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    # Release the memory map and everything decoded from it; the stream
+    # belongs to the caller and stays open. A mapping still referenced by
+    # data handed out earlier is unmapped once that data is dropped.
+    for cache in self.cache_info().values():
+      cache.clear()
+    self.inode_tables = {}
+    self.xattr_values = {}
+
+    if self.view is not None:
+      self.view.release()
+      self.view = None
+    if self.mmap is not None:
+      try:
+        self.mmap.close()
+      except BufferError:
+        pass
+      self.mmap = None
 
   def __repr__(self):
     return "{type_name:s}(volume_name = {volume_name!r:s}, uuid = {uuid!r:s}, last_mounted = {last_mounted!r:s})".format(
@@ -527,13 +895,29 @@ class Volume:
   def block_size(self):
     return 1 << (10 + self.superblock.s_log_block_size)
 
+  def cache_info(self):
+    return {"inode": self.inode_cache, "dentry": self.dentry_cache, "xattr": self.xattr_block_cache}
+
   def get_inode(self, inode_idx, file_type=InodeType.UNKNOWN):
+    inode = self.inode_cache.get((inode_idx, file_type))
+    if inode is None:
+      inode = self._get_inode(inode_idx, file_type)
+      self.inode_cache.put((inode_idx, file_type), inode)
+
+    return inode
+
+  def _get_inode(self, inode_idx, file_type):
     group_idx, inode_table_entry_idx = self.get_inode_group(inode_idx)
 
     inode_table_offset = self.group_descriptors[group_idx].bg_inode_table * self.block_size
     inode_offset = inode_table_offset + \
       inode_table_entry_idx * self.superblock.s_inode_size
 
+    inode_table = self.inode_tables.get(group_idx)
+    if inode_table is not None and inode_table_entry_idx < len(inode_table):
+      return Inode(self, inode_offset, inode_idx, file_type,
+                   raw=inode_table.get_raw_inode(inode_table_entry_idx))
+
     return Inode(self, inode_offset, inode_idx, file_type)
 
   def get_inode_group(self, inode_idx):
@@ -542,13 +926,135 @@ class Volume:
       inode_idx - 1) % self.superblock.s_inodes_per_group
     return (group_idx, inode_table_entry_idx)
 
+  def lookup(self, dir_inode, name, decode_name=None):
+    # Resolve name in dir_inode to (inode_idx, file_type), (None, None) if missing
+    if decode_name is not None:
+      # Custom name decoding can't share the cache
+      _, inode_idx, file_type = next(filter(lambda entry: entry[0] == name, dir_inode.open_dir(
+        decode_name)), (None, None, None))
+      return (inode_idx, file_type)
+
+    key = (dir_inode.inode_idx, name)
+    entry = self.dentry_cache.get(key)
+
+    if entry is None and (dir_inode.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
+      # Hash tree directory: only read the leaf block holding the name
+      entry = dir_inode.dx_lookup(name.encode("utf8"))
+      if entry is not None:
+        self.dentry_cache.put(key, entry)
+
+    if entry is None:
+      # Index the whole directory at once so that sibling lookups are hits
+      entry = (None, None)
+      for entry_name, entry_inode_idx, entry_type in dir_inode.open_dir():
+        self.dentry_cache.put(
+          (dir_inode.inode_idx, entry_name), (entry_inode_idx, entry_type))
+        if entry_name == name:
+          entry = (entry_inode_idx, entry_type)
+
+      self.dentry_cache.put(key, entry)
+
+    return entry
+
+  def walk(self, top=None, include=None, exclude=None, breadth_first=False, decode_name=None):
+    # Iterate the tree below top (default: root) with an explicit stack,
+    # yielding (path, inode_idx, file_type, inode) for each entry except '.'
+    # and '..', where path is "/a/b" relative to top and inode() returns the
+    # decoded Inode. Entries for which include(path, file_type) is false or
+    # exclude(path, file_type) is true are skipped together with their
+    # subtree, which is then never read. A walk of the whole tree (no top
+    # nor include) visits nearly every inode, so it first loads the inode
+    # tables with load_inode_tables().
+    if top is None:
+      if include is None:
+        self.load_inode_tables()
+      top = self.root
+
+    dirs = collections.deque([("", iter(top.open_dir(decode_name)))])
+
+    while dirs:
+      dir_path, entries = dirs[0] if breadth_first else dirs[-1]
+
+      for entry_name, entry_inode_idx, entry_type in entries:
+        if entry_inode_idx == 0 or entry_name in (".", ".."):
+          continue
+
+        path = dir_path + "/" + entry_name
+        if exclude is not None and exclude(path, entry_type):
+          continue
+        if include is not None and not include(path, entry_type):
+          continue
+
+        inode = functools.partial(self.get_inode, entry_inode_idx, entry_type)
+        yield (path, entry_inode_idx, entry_type, inode)
+
+        if entry_type == InodeType.DIRECTORY or (entry_type == InodeType.UNKNOWN and inode().is_dir):
+          dirs.append((path, iter(inode().open_dir(decode_name))))
+          if not breadth_first:
+            break  # descend first, resume this directory afterwards
+      else:
+        if breadth_first:
+          dirs.popleft()
+        else:
+          dirs.pop()
+
+  def intern_xattr_value(self, value):
+    # Thousands of inodes carry the same few SELinux labels, share one object
+    if len(value) > Volume.XATTR_INTERN_SIZE:
+      return value
+    return self.xattr_values.setdefault(value, value)
+
+  def load_inode_tables(self):
+    # Read the used part of every inode table with one read per block group,
+    # get_inode() then decodes inodes from memory
+    for group_idx in range(len(self.group_descriptors)):
+      if group_idx not in self.inode_tables:
+        self.inode_tables[group_idx] = self.read_inode_table(group_idx)
+
+  def read_inode_table(self, group_idx):
+    return InodeTable(self, group_idx)
+
   def read(self, offset, byte_len):
-    if self.offset + offset != self.stream.tell():
-      self.stream.seek(self.offset + offset, io.SEEK_SET)
+    if self.view is not None:
+      start = self.offset + offset
+      return self.view[start: start + byte_len]
+
+    if self.fd is not None:
+      return os.pread(self.fd, byte_len, self.offset + offset)
+
+    with self.lock:
+      if self.offset + offset != self.stream.tell():
+        self.stream.seek(self.offset + offset, io.SEEK_SET)
+
+      return self.stream.read(byte_len)
+
+  def readinto(self, offset, buffer):
+    if self.view is not None:
+      start = self.offset + offset
+      data = self.view[start: start + len(buffer)]
+      buffer[:len(data)] = data
+      return len(data)
+
+    if self.fd is not None:
+      if hasattr(os, "preadv"):
+        return os.preadv(self.fd, [buffer], self.offset + offset)
+
+      data = os.pread(self.fd, len(buffer), self.offset + offset)
+      buffer[:len(data)] = data
+      return len(data)
+
+    with self.lock:
+      if self.offset + offset != self.stream.tell():
+        self.stream.seek(self.offset + offset, io.SEEK_SET)
 
-    return self.stream.read(byte_len)
+      return self.stream.readinto(buffer)
 
   def read_struct(self, structure, offset, platform64=None):
+    if self.mmap is not None and not hasattr(structure, "_from_buffer_copy"):
+      # Decode straight from the mapping (structures with _from_buffer_copy
+      # may patch fields, so they keep working on a private copy)
+      return structure.from_buffer(self.mmap, self.offset + offset)
+
     raw = self.read(offset, ctypes.sizeof(structure))
 
     if hasattr(structure, "_from_buffer_copy"):
@@ -567,14 +1073,104 @@ class Volume:
     return "-".join("".join("{0:02X}".format(c) for c in part) for part in uuid)
 
 
+class InodeTable:
+  # Columnar view of the used inodes of one block group's inode table
+  COLUMNS = ("inode_idx", "mode", "uid", "gid",
+             "size", "links_count", "flags", "file_acl")
+
+  # i_mode, i_uid_lo, i_size_lo, i_gid_lo, i_links_count, i_flags,
+  # i_file_acl_lo, i_size_hi, i_file_acl_hi, i_uid_hi, i_gid_hi
+  _ROW_FORMAT = "<HHI16xHH4xI4x60x4xII4x2xHHH{padding:d}x"
+  _row_structs = {}  # Precompiled row decoders by inode size
+
+  def __init__(self, volume, group_idx):
+    self.volume = volume
+    self.group_idx = group_idx
+
+    superblock = volume.superblock
+    group_descriptor = volume.group_descriptors[group_idx]
+    inode_size = superblock.s_inode_size
+
+    self.first_inode_idx = group_idx * superblock.s_inodes_per_group + 1
+    self.inode_count = superblock.s_inodes_per_group
+    if (superblock.s_feature_ro_compat & (ext4_superblock.RO_COMPAT_GDT_CSUM | ext4_superblock.RO_COMPAT_METADATA_CSUM)) != 0:
+      if (group_descriptor.bg_flags & ext4_group_descriptor.EXT4_BG_INODE_UNINIT) != 0:
+        self.inode_count = 0
+      else:
+        self.inode_count -= group_descriptor.bg_itable_unused
+
+    # One read for the whole table, padded so the last inode can be decoded
+    # as a full ext4_inode even if s_inode_size is smaller
+    self.raw = volume.read(group_descriptor.bg_inode_table * volume.block_size,
+                           self.inode_count * inode_size + max(0, ctypes.sizeof(ext4_inode) - inode_size))
+
+    row_struct = InodeTable._row_structs.get(inode_size)
+    if row_struct is None:
+      row_struct = struct.Struct(
+        InodeTable._ROW_FORMAT.format(padding=inode_size - 0x7C))
+      InodeTable._row_structs[inode_size] = row_struct
+
+    self.mode = array.array("H")
+    self.uid = array.array("I")
+    self.gid = array.array("I")
+    self.size = array.array("Q")
+    self.links_count = array.array("H")
+    self.flags = array.array("I")
+    self.file_acl = array.array("Q")
+
+    for mode, uid_lo, size_lo, gid_lo, links_count, flags, file_acl_lo, size_hi, file_acl_hi, uid_hi, gid_hi in \
+        row_struct.iter_unpack(self.raw[:self.inode_count * inode_size]):
+      self.mode.append(mode)
+      self.uid.append((uid_hi << 16) | uid_lo)
+      self.gid.append((gid_hi << 16) | gid_lo)
+      self.size.append((size_hi << 32) | size_lo)
+      self.links_count.append(links_count)
+      self.flags.append(flags)
+      self.file_acl.append((file_acl_hi << 32) | file_acl_lo)
+
+  def __len__(self):
+    return self.inode_count
+
+  def __repr__(self):
+    return "{type_name:s}(group_idx = {group_idx!r:s}, inode_count = {inode_count!r:s}, volume_uuid = {uuid!r:s})".format(
+      group_idx=self.group_idx,
+      inode_count=self.inode_count,
+      type_name=type(self).__name__,
+      uuid=self.volume.uuid
+    )
+
+  def get_raw_inode(self, inode_table_entry_idx):
+    offset = inode_table_entry_idx * self.volume.superblock.s_inode_size
+    return self.raw[offset: offset + max(self.volume.superblock.s_inode_size, ctypes.sizeof(ext4_inode))]
+
+  def rows(self):
+    # Export the table as tuples in the order of COLUMNS
+    return zip(range(self.first_inode_idx, self.first_inode_idx + self.inode_count),
+               self.mode, self.uid, self.gid, self.size, self.links_count, self.flags, self.file_acl)
+
+
 class Inode:
-  def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN):
+  # Default buffer size of the streaming API
+  CHUNK_SIZE = 1 << 20
+
+  def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN, raw=None):
     self.inode_idx = inode_idx
     self.offset = offset
     self.volume = volume
 
     self.file_type = file_type
-    self.inode = volume.read_struct(ext4_inode, offset)
+
+    # Raw inode including the inline xattr area, unless already loaded with
+    # its inode table this is the only read made for the inode
+    if raw is None:
+      raw = volume.read(offset, max(
+        volume.superblock.s_inode_size, ctypes.sizeof(ext4_inode)))
+    self.raw = raw
+
+    if volume.mmap is not None:
+      self.inode = volume.read_struct(ext4_inode, offset)
+    else:
+      self.inode = ext4_inode.from_buffer_copy(raw)
 
   def __len__(self):
     return self.inode.i_size
@@ -643,8 +1239,8 @@ class Inode:
         xattr_value = xattr_inode.open_read().read()
       else:
         # internal xattr
-        xattr_value = raw_data[
-          xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]
+        xattr_value = self.volume.intern_xattr_value(bytes(raw_data[
+          xattr_entry.e_value_offs + offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]))
 
       yield (xattr_name, xattr_value)
 
@@ -677,8 +1273,8 @@ class Inode:
           inode=inode_idx
         ))
 
-      file_name, inode_idx, file_type = next(
-        filter(lambda entry: entry[0] == part, current_inode.open_dir(decode_name)), (None, None, None))
+      inode_idx, file_type = self.volume.lookup(
+        current_inode, part, decode_name)
 
       if inode_idx == None:
         current_path = "/".join(relative_path[:i])
@@ -776,6 +1372,89 @@ class Inode:
                    (self.inode.i_mode & ext4_inode.S_ISVTX) != 0),
     ])
 
+  def dx_lookup(self, name):
+    # Named lookup through the directory's hash tree, returning
+    # (inode_idx, file_type), (None, None) if missing and None if the tree
+    # can't be used (then the caller falls back to a linear scan)
+    if name in (b".", b".."):
+      # Only present in the dx_root block, not in the leaves
+      return None
+
+    reader = self.open_read()
+    block_size = self.volume.block_size
+
+    def read_block(block_idx):
+      reader.seek((block_idx & 0x0FFFFFFF) * block_size)
+      return reader.read(block_size)
+
+    def read_entries(block, offset):
+      count = ext4_dx_countlimit.from_buffer_copy(block, offset).count
+      return (ext4_dx_entry * count).from_buffer_copy(block, offset)
+
+    root = read_block(0)
+    root_info = ext4_dx_root_info.from_buffer_copy(root, 0x18)
+    if root_info.reserved_zero != 0 or root_info.info_length != 0x8:
+      return None
+
+    hash_version = root_info.hash_version
+    if hash_version <= DxHash.TEA and (self.volume.superblock.s_flags & ext4_superblock.EXT2_FLAGS_UNSIGNED_HASH) != 0:
+      hash_version += DxHash.LEGACY_UNSIGNED
+    if hash_version > DxHash.TEA_UNSIGNED:
+      return None
+
+    hash, _ = ext4_dirhash(name, hash_version,
+                           self.volume.superblock.s_hash_seed)
+
+    # Descend from dx_root through dx_node blocks, remembering the path
+    frames = []
+    entries = read_entries(root, 0x18 + root_info.info_length)
+    while True:
+      lo, hi = 1, len(entries)
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if entries[mid].hash > hash:
+          hi = mid
+        else:
+          lo = mid + 1
+      frames.append([entries, lo - 1])
+
+      if len(frames) > root_info.indirect_levels:
+        break
+      # dx_node blocks start with a fake empty directory entry
+      entries = read_entries(read_block(entries[lo - 1].block), 0x8)
+
+    while True:
+      entries, at = frames[-1]
+      leaf = read_block(entries[at].block)
+
+      offset = 0
+      while offset < len(leaf):
+        dirent = ext4_dir_entry_2._from_buffer_copy(
+          leaf, offset, platform64=self.volume.platform64)
+        if dirent.rec_len == 0:
+          break
+        if dirent.inode != 0 and dirent.file_type != InodeType.CHECKSUM and dirent.name == name:
+          return (dirent.inode, dirent.file_type)
+        offset += dirent.rec_len
+
+      # Not in this leaf: the name can only continue in the next leaf if
+      # that one starts with the same hash (collision bit set)
+      level = len(frames) - 1
+      while level >= 0 and frames[level][1] + 1 >= len(frames[level][0]):
+        level -= 1
+      if level < 0:
+        return (None, None)
+
+      frames[level][1] += 1
+      next_hash = frames[level][0][frames[level][1]].hash
+      if (next_hash & ~1) != hash:
+        return (None, None)
+
+      for child in range(level + 1, len(frames)):
+        parent_entries, parent_at = frames[child - 1]
+        frames[child] = [read_entries(read_block(
+          parent_entries[parent_at].block), 0x8), 0]
+
   def open_dir(self, decode_name=None):
     # Parse args
     if decode_name == None:
@@ -785,9 +1464,8 @@ class Inode:
       raise Ext4Error(
         "Inode ({inode:d}) is not a directory.".format(inode=self.inode_idx))
 
-    # # Hash trees are compatible with linear arrays
-    if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
-      pass
+    # Hash trees are compatible with linear arrays: full enumeration reads
+    # the leaves linearly, named lookups go through dx_lookup()
 
     # Read raw directory content
     raw_data = self.open_read().read()
@@ -807,41 +1485,126 @@ class Inode:
       # Obtain mapping from extents
       mapping = []  # List of MappingEntry instances
 
+      # The root node is i_block of the raw inode, only deeper nodes are read
       nodes = queue.Queue()
-      nodes.put_nowait(self.offset + ext4_inode.i_block.offset)
+      nodes.put_nowait(None)
 
       while nodes.qsize() != 0:
         header_offset = nodes.get_nowait()
-        header = self.volume.read_struct(ext4_extent_header, header_offset)
+        if header_offset is None:
+          header_offset = self.offset + ext4_inode.i_block.offset
+          node = self.raw[ext4_inode.i_block.offset:
+                          ext4_inode.i_block.offset + ext4_inode.i_block.size]
+        else:
+          node = self.volume.read(header_offset, self.volume.block_size)
+        header = ext4_extent_header.from_buffer_copy(node)
 
         if not self.volume.ignore_magic and header.eh_magic != 0xF30A:
           raise MagicError(
             "Invalid magic value in extent header at offset 0x{header_offset:X} of inode {inode:d}: 0x{header_magic:04X} (expected 0xF30A)".format(
               header_magic=header.eh_magic,
-              header_offset=self.inode_idx,
+              header_offset=header_offset,
               inode=self.inode_idx
             ))
 
         if header.eh_depth != 0:
-          indices = self.volume.read_struct(ext4_extent_idx * header.eh_entries,
-                                            header_offset + ctypes.sizeof(ext4_extent_header))
+          indices = (ext4_extent_idx * header.eh_entries).from_buffer_copy(
+            node, ctypes.sizeof(ext4_extent_header))
           for idx in indices:
             nodes.put_nowait(idx.ei_leaf * self.volume.block_size)
         else:
-          extents = self.volume.read_struct(ext4_extent * header.eh_entries,
-                                            header_offset + ctypes.sizeof(ext4_extent_header))
+          extents = (ext4_extent * header.eh_entries).from_buffer_copy(
+            node, ctypes.sizeof(ext4_extent_header))
           for extent in extents:
+            if extent.ee_len > ext4_extent.EXT_INIT_MAX_LEN:
+              # Unwritten (preallocated) extent, reads back as zeros: leave
+              # it out of the mapping so it is handled like a hole
+              continue
+
             mapping.append(MappingEntry(
               extent.ee_block, extent.ee_start, extent.ee_len))
 
-      MappingEntry.optimize(mapping)
       return BlockReader(self.volume, len(self), mapping)
     else:
-      # Inode uses inline data
-      i_block = self.volume.read(
-        self.offset + ext4_inode.i_block.offset, ext4_inode.i_block.size)
+      # Inode uses inline data, part of the raw inode
+      i_block = bytes(self.raw[ext4_inode.i_block.offset:
+                               ext4_inode.i_block.offset + ext4_inode.i_block.size])
       return io.BytesIO(i_block[:self.inode.i_size])
 
+  def iter_chunks(self, size=CHUNK_SIZE):
+    reader = self.open_read()
+
+    while True:
+      chunk = reader.read(size)
+      if not chunk:
+        break
+      yield chunk
+
+  def copy_to(self, fileobj, size=CHUNK_SIZE):
+    # Stream file content through one reusable buffer of the given size.
+    # Holes and unwritten extents are skipped with seek() so that the output
+    # stays sparse; they are written out as zeros only if fileobj can't seek.
+    reader = self.open_read()
+    buffer = memoryview(bytearray(size))
+
+    if not isinstance(reader, BlockReader):
+      runs = [(0, 0, len(self))]
+    else:
+      runs = reader.iter_runs()
+
+    sparse = fileobj.seekable() if hasattr(fileobj, "seekable") else False
+    total = 0
+
+    for file_offset, disk_offset, byte_len in runs:
+      if disk_offset is None:
+        if sparse:
+          fileobj.seek(byte_len, io.SEEK_CUR)
+          total += byte_len
+          continue
+
+        # Unseekable output: write zeros from a cleared buffer
+        buffer[:] = bytes(size)
+
+      reader.seek(file_offset)
+      while byte_len > 0:
+        read_len = min(byte_len, size)
+        if disk_offset is not None:
+          read_len = reader.readinto(buffer[:read_len])
+          if not read_len:
+            raise EndOfStreamError(
+              "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len))
+        fileobj.write(buffer[:read_len])
+        byte_len -= read_len
+        total += read_len
+
+    if sparse and fileobj.seek(0, io.SEEK_END) < total:
+      # Materialise a trailing hole (BytesIO can't be extended by truncate)
+      fileobj.truncate(total)
+      if fileobj.seek(0, io.SEEK_END) < total:
+        fileobj.seek(total - 1)
+        fileobj.write(b"\0")
+
+    return total
+
+  def copy_to_fd(self, fd):
+    # Zero-copy extraction: every contiguous extent run is copied from the
+    # image to fd by the kernel, holes are left unwritten
+    reader = self.open_read()
+
+    if not isinstance(reader, BlockReader):
+      # Inline data lives in the inode itself
+      os.write(fd, reader.read())
+      return len(self)
+
+    image_fd = self.volume.stream.fileno()
+    for file_offset, disk_offset, byte_len in reader.iter_runs():
+      if disk_offset is not None:
+        copy_fd_range(image_fd, self.volume.offset + disk_offset,
+                      fd, file_offset, byte_len)
+
+    os.ftruncate(fd, len(self))
+    return len(self)
+
   @property
   def size_readable(self):
     if self.inode.i_size < 1024:
@@ -863,7 +1626,9 @@ class Inode:
       self.volume.superblock.s_inode_size - inline_data_offset
 
     if check_inline and inline_data_length > ctypes.sizeof(ext4_xattr_ibody_header):
-      inline_data = self.volume.read(inline_data_offset, inline_data_length)
+      # The inline area is part of the raw inode loaded with the structure
+      inline_data = self.raw[inline_data_offset - self.offset:
+                             inline_data_offset - self.offset + inline_data_length]
       xattrs_header = ext4_xattr_ibody_header.from_buffer_copy(inline_data)
 
       # TODO Find way to detect inline xattrs without checking the h_magic field to enable error detection with the h_magic field.
@@ -876,54 +1641,75 @@ class Inode:
           yield (xattr_name, xattr_value)
       except:
         pass
-    # xattr block(s)
+    # xattr block(s), shared by many inodes and parsed once per volume
     if check_block and self.inode.i_file_acl != 0:
-      xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
-      xattrs_block = self.volume.read(
-        xattrs_block_start, self.volume.block_size)
+      xattrs = self.volume.xattr_block_cache.get(self.inode.i_file_acl)
+      if xattrs is None:
+        xattrs = tuple(self._read_xattr_block(prefix_override))
+        self.volume.xattr_block_cache.put(self.inode.i_file_acl, xattrs)
 
-      xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
-      if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
-        try:
-          raise MagicError(
-            "Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of inode {inode:d}: 0x{xattrs_header} (expected 0xEA020000)".format(
-              inode=self.inode_idx,
-              xattrs_block_start=xattrs_block_start,
-              xattrs_header=xattrs_header.h_magic
-            ))
-        except:
-          pass
+      for xattr_name, xattr_value in xattrs:
+        yield (xattr_name, xattr_value)
+
+  def _read_xattr_block(self, prefix_override={}):
+    xattrs_block_start = self.inode.i_file_acl * self.volume.block_size
+    xattrs_block = self.volume.read(
+      xattrs_block_start, self.volume.block_size)
 
-      if xattrs_header.h_blocks != 1:
-        raise Ext4Error(
-          "Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} of inode {inode:d}: {xattrs_header:d} (expected 1)".format(
+    xattrs_header = ext4_xattr_header.from_buffer_copy(xattrs_block)
+    if not self.volume.ignore_magic and xattrs_header.h_magic != 0xEA020000:
+      try:
+        raise MagicError(
+          "Invalid magic value in xattrs block header at offset 0x{xattrs_block_start:X} of inode {inode:d}: 0x{xattrs_header} (expected 0xEA020000)".format(
             inode=self.inode_idx,
-            xattrs_header=xattrs_header.h_blocks,
-            xattrs_block_start=xattrs_block_start
+            xattrs_block_start=xattrs_block_start,
+            xattrs_header=xattrs_header.h_magic
           ))
+      except:
+        pass
 
-      offset = 4 * ((ctypes.sizeof(
-        ext4_xattr_header) + 3) // 4)  # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
-      for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset,
-                                                        prefix_override=prefix_override):
-        yield (xattr_name, xattr_value)
+    if xattrs_header.h_blocks != 1:
+      raise Ext4Error(
+        "Invalid number of xattr blocks at offset 0x{xattrs_block_start:X} of inode {inode:d}: {xattrs_header:d} (expected 1)".format(
+          inode=self.inode_idx,
+          xattrs_header=xattrs_header.h_blocks,
+          xattrs_block_start=xattrs_block_start
+        ))
 
+    offset = 4 * ((ctypes.sizeof(
+      ext4_xattr_header) + 3) // 4)  # The ext4_xattr_entry following the header is aligned on a 4-byte boundary
+    for xattr_name, xattr_value in self._parse_xattrs(xattrs_block[offset:], -offset,
+                                                      prefix_override=prefix_override):
+      yield (xattr_name, xattr_value)
 
-class BlockReader:
+
+class BlockReader(io.RawIOBase):
   # OSError
   EINVAL = 22
 
   def __init__(self, volume, byte_size, block_map):
+    super().__init__()
     self.byte_size = byte_size
     self.volume = volume
 
     self.cursor = 0
 
-    block_map = list(map(MappingEntry.copy, block_map))
-
-    # Optimize mapping (stich together)
-    MappingEntry.optimize(block_map)
-    self.block_map = block_map
+    # Extent map as parallel arrays sorted by file block, stitched together
+    # while building so that block_map entries are never copied or mutated
+    self.file_blocks = array.array("Q")
+    self.disk_blocks = array.array("Q")
+    self.block_counts = array.array("Q")
+
+    for file_block_idx, disk_block_idx, block_count in sorted(
+        block_map, key=lambda entry: entry.file_block_idx):
+      if self.file_blocks \
+          and self.file_blocks[-1] + self.block_counts[-1] == file_block_idx \
+          and self.disk_blocks[-1] + self.block_counts[-1] == disk_block_idx:
+        self.block_counts[-1] += block_count
+      else:
+        self.file_blocks.append(file_block_idx)
+        self.disk_blocks.append(disk_block_idx)
+        self.block_counts.append(block_count)
 
   def __repr__(self):
     return "{type_name:s}(byte_size = {size!r:s}, block_map = {block_map!r:s}, volume_uuid = {uuid!r:s})".format(
@@ -933,17 +1719,39 @@ class BlockReader:
       uuid=self.volume.uuid
     )
 
+  @property
+  def block_map(self):
+    return [MappingEntry(*entry) for entry in zip(self.file_blocks, self.disk_blocks, self.block_counts)]
+
+  def iter_runs(self):
+    # (file offset, disk offset or None for holes, length) covering the file
+    block_size = self.volume.block_size
+    file_offset = 0
+
+    for file_block_idx, disk_block_idx, block_count in zip(self.file_blocks, self.disk_blocks, self.block_counts):
+      run_start = min(file_block_idx * block_size, self.byte_size)
+      run_end = min((file_block_idx + block_count) * block_size, self.byte_size)
+
+      if file_offset < run_start:
+        yield (file_offset, None, run_start - file_offset)
+      if run_start < run_end:
+        yield (run_start, disk_block_idx * block_size, run_end - run_start)
+      file_offset = max(file_offset, run_end)
+
+    if file_offset < self.byte_size:
+      yield (file_offset, None, self.byte_size - file_offset)
+
+  def _find_run(self, file_block_idx):
+    # Index of the last run starting at or before file_block_idx (-1 if none)
+    return bisect.bisect_right(self.file_blocks, file_block_idx) - 1
+
   def get_block_mapping(self, file_block_idx):
-    disk_block_idx = None
+    idx = self._find_run(file_block_idx)
 
-    # Find disk block
-    for entry in self.block_map:
-      if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-        block_diff = file_block_idx - entry.file_block_idx
-        disk_block_idx = entry.disk_block_idx + block_diff
-        break
+    if idx >= 0 and file_block_idx < self.file_blocks[idx] + self.block_counts[idx]:
+      return self.disk_blocks[idx] + file_block_idx - self.file_blocks[idx]
 
-    return disk_block_idx
+    return None
 
   def read(self, byte_len=-1):
     # Parse args
@@ -957,30 +1765,58 @@ class BlockReader:
     if byte_len == 0:
       return b""
 
-    # Reading blocks
-    start_block_idx = self.cursor // self.volume.block_size
-    end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
-    end_of_stream_check = byte_len
+    result = bytearray(byte_len)
+    self.readinto(result)
+    return bytes(result)
 
-    blocks = [self.read_block(i) for i in range(
-      start_block_idx, end_block_idx - start_block_idx + 1)]
+  def readall(self):
+    return self.read()
 
-    start_offset = self.cursor % self.volume.block_size
-    if start_offset != 0:
-      blocks[0] = blocks[0][start_offset:]
-    byte_len = (byte_len + start_offset - self.volume.block_size -
-                1) % self.volume.block_size + 1
-    blocks[-1] = blocks[-1][:byte_len]
+  def readable(self):
+    return True
 
-    result = b"".join(blocks)
+  def readinto(self, buffer):
+    buffer = memoryview(buffer).cast("B")
+    byte_len = max(0, min(len(buffer), self.byte_size - self.cursor))
 
-    # Check read
-    if len(result) != end_of_stream_check:
-      raise EndOfStreamError(
-        "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len - len(result)))
+    if byte_len == 0:
+      return 0
+
+    block_size = self.volume.block_size
+    start = self.cursor
+    end = start + byte_len
+
+    # One read per physically contiguous run instead of one per block;
+    # holes are left untouched and filled with zeros here
+    hole_start = start
+    for idx in range(max(0, self._find_run(start // block_size)), len(self.file_blocks)):
+      file_block_idx = self.file_blocks[idx]
+      if file_block_idx * block_size >= end:
+        break
 
-    self.cursor += len(result)
-    return result
+      disk_block_idx = self.disk_blocks[idx]
+      run_start = max(start, file_block_idx * block_size)
+      run_end = min(end, (file_block_idx + self.block_counts[idx]) * block_size)
+      if run_start >= run_end:
+        continue
+
+      buffer[hole_start - start: run_start - start] = bytes(run_start - hole_start)
+      disk_offset = disk_block_idx * block_size + \
+        run_start - file_block_idx * block_size
+      read_len = self.volume.readinto(
+        disk_offset, buffer[run_start - start: run_end - start])
+
+      # Check read
+      if read_len != run_end - run_start:
+        raise EndOfStreamError(
+          "The volume's underlying stream ended {0:d} bytes before EOF.".format(run_end - run_start - read_len))
+
+      hole_start = run_end
+
+    buffer[hole_start - start: byte_len] = bytes(end - hole_start)
+
+    self.cursor = end
+    return byte_len
 
   def read_block(self, file_block_idx):
     disk_block_idx = self.get_block_mapping(file_block_idx)
@@ -988,7 +1824,7 @@ class BlockReader:
     if disk_block_idx != None:
       return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
     else:
-      return bytes([0] * self.volume.block_size)
+      return bytes(self.volume.block_size)
 
   def seek(self, seek, seek_mode=io.SEEK_SET):
     if seek_mode == io.SEEK_CUR:
@@ -1005,5 +1841,8 @@ class BlockReader:
     self.cursor = seek
     return seek
 
+  def seekable(self):
+    return True
+
   def tell(self):
     return self.cursor
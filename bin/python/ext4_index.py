@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import hashlib
+import os
+import posixpath
+import sqlite3
+import struct
+
+import ext4
+
+IndexEntry = collections.namedtuple('IndexEntry', [
+  'path', 'inode', 'type', 'mode', 'uid', 'gid', 'size', 'links',
+  'context', 'link_target', 'sha256'])
+
+
+class Ext4Index():
+  """
+  SQLite index of every path of an ext4 image (inode, type, mode, owner,
+  size, security.selinux value as stored, usually with its trailing NUL,
+  extents and optionally a SHA-256 of the content),
+  stored next to the image as <image>.index.db. It is keyed by the image
+  size and mtime and by the superblock UUID, write time and checksum, and
+  is ignored as soon as any of them changes.
+  """
+
+  VERSION = 1
+  SUFFIX = '.index.db'
+
+  def __init__(self, image_name, index_file=None, use_mmap=True):
+    self.image_name = os.path.realpath(image_name)
+    self.index_file = index_file or self.image_name + self.SUFFIX
+    self.use_mmap = use_mmap
+    self.db = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      self.db = None
+
+  def image_key(self):
+    # Image size, mtime and the superblock fields changed by every write
+    st = os.stat(self.image_name)
+    with open(self.image_name, 'rb') as file:
+      file.seek(0x400)
+      superblock = ext4.ext4_superblock._from_buffer_copy(file.read(0x400))
+
+    return '{size:d}:{mtime:d}:{uuid:s}:{wtime:d}:{checksum:08x}'.format(
+      size=st.st_size,
+      mtime=st.st_mtime_ns,
+      uuid=bytes(superblock.s_uuid).hex(),
+      wtime=superblock.s_wtime,
+      checksum=superblock.s_checksum)
+
+  def __connect(self):
+    if self.db is None:
+      self.db = sqlite3.connect(self.index_file)
+    return self.db
+
+  def is_valid(self, hash_content=False):
+    # up to date with the image, and holding content hashes if they are wanted
+    if not os.path.isfile(self.index_file):
+      return False
+
+    try:
+      meta = dict(self.__connect().execute('SELECT key, value FROM meta'))
+    except sqlite3.DatabaseError:
+      return False
+
+    if hash_content and meta.get('hash_content') != '1':
+      return False
+    return meta.get('version') == str(self.VERSION) and meta.get('image') == self.image_key()
+
+  def build(self, volume=None, hash_content=False):
+    """
+    (re)create the index from the image, or from an already open volume
+    """
+    if volume is None:
+      with open(self.image_name, 'rb') as file, ext4.Volume(file, use_mmap=self.use_mmap) as volume:
+        return self.build(volume, hash_content)
+
+    self.close()
+    if os.path.isfile(self.index_file):
+      os.remove(self.index_file)
+
+    db = self.__connect()
+    with db:
+      db.executescript('''
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE entries (
+          path TEXT PRIMARY KEY, parent TEXT, inode INTEGER, type INTEGER,
+          mode INTEGER, uid INTEGER, gid INTEGER, size INTEGER, links INTEGER,
+          context TEXT, link_target TEXT, sha256 TEXT, extents BLOB
+        ) WITHOUT ROWID;
+        CREATE INDEX entries_parent ON entries (parent);
+      ''')
+      db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     self.__rows(volume, hash_content))
+      db.executemany('INSERT INTO meta VALUES (?, ?)', [
+        ('version', str(self.VERSION)),
+        ('image', self.image_key()),
+        ('block_size', str(volume.block_size)),
+        ('hash_content', str(int(hash_content)))])
+
+  def __rows(self, volume, hash_content):
+    contexts = {}  # raw security.selinux value -> decoded value
+
+    yield self.__row('/', volume.root, contexts, hash_content)
+    for path, _, _, inode in volume.walk():
+      yield self.__row(path, inode(), contexts, hash_content)
+
+  def __row(self, path, entry_inode, contexts, hash_content):
+    raw = entry_inode.inode
+    context = link_target = digest = extents = None
+
+    for name, value in entry_inode.xattrs():
+      if name == 'security.selinux':
+        context = contexts.get(value)
+        if context is None:
+          context = contexts[value] = value.decode('utf-8')
+
+    if entry_inode.is_symlink:
+      link_target = entry_inode.open_read().read().decode('utf-8')
+    elif entry_inode.is_file:
+      reader = entry_inode.open_read()
+      if isinstance(reader, ext4.BlockReader):
+        runs = [value for run in zip(reader.file_blocks, reader.disk_blocks, reader.block_counts)
+                for value in run]
+        extents = struct.pack('<{0:d}Q'.format(len(runs)), *runs)
+      if hash_content:
+        sha256 = hashlib.sha256()
+        for chunk in entry_inode.iter_chunks():
+          sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+    return (path, posixpath.dirname(path), entry_inode.inode_idx, entry_inode.file_type,
+            raw.i_mode, raw.i_uid, raw.i_gid, len(entry_inode), raw.i_links_count,
+            context, link_target, digest, extents)
+
+  def open(self, hash_content=False):
+    """
+    load the index, building it first if it is missing, stale or without
+    the content hashes asked for
+    """
+    if not self.is_valid(hash_content):
+      self.build(hash_content=hash_content)
+    return self
+
+  def __query(self, where='', args=()):
+    return map(IndexEntry._make, self.__connect().execute(
+      'SELECT path, inode, type, mode, uid, gid, size, links, context, link_target, sha256 '
+      'FROM entries ' + where, args))
+
+  def entries(self):
+    # every entry in path order, parents before their children
+    return self.__query('ORDER BY path')
+
+  def stat(self, path):
+    entry = next(self.__query('WHERE path = ?', (path,)), None)
+    if entry is None:
+      raise FileNotFoundError(path)
+    return entry
+
+  def listdir(self, path='/'):
+    return self.__query('WHERE parent = ? AND path != ? ORDER BY path', (path, path))
+
+  def extents(self, path):
+    # [(file_block, disk_block, block_count), ...] of a regular file, None
+    # for other entries and files with inline data
+    row = self.__connect().execute(
+      'SELECT extents FROM entries WHERE path = ?', (path,)).fetchone()
+    if row is None:
+      raise FileNotFoundError(path)
+    if row[0] is None:
+      return None
+
+    runs = struct.unpack('<{0:d}Q'.format(len(row[0]) // 8), row[0])
+    return list(zip(runs[0::3], runs[1::3], runs[2::3]))
+
+
+def parser():
+  parser = argparse.ArgumentParser(
+    description='Build or query the index of an ext4 image')
+  parser.add_argument('image', help='ext4 image')
+  parser.add_argument('path', nargs='?', help='List this directory or show this file')
+  parser.add_argument('--hash', dest='hash_content', action='store_true',
+                      help='Store a SHA-256 of every file content')
+  parser.add_argument('--rebuild', action='store_true', help='Rebuild even if the index is valid')
+  parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                      help='Read the image with pread instead of mapping it in memory')
+  return parser
+
+
+if __name__ == '__main__':
+  args = parser().parse_args()
+  with Ext4Index(args.image, use_mmap=args.use_mmap) as index:
+    if args.rebuild:
+      index.build(hash_content=args.hash_content)
+    else:
+      index.open(hash_content=args.hash_content)
+
+    if args.path:
+      entry = index.stat(args.path)
+      for child in (index.listdir(args.path) if ext4.InodeType.DIRECTORY == entry.type else [entry]):
+        print(f'{child.mode:06o} {child.uid:5d} {child.gid:5d} {child.size:12d} {child.path} {(child.context or "").rstrip(chr(0))}')
+    else:
+      print(f':: Index -> {index.index_file}')
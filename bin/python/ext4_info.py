@@ -1,19 +1,95 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import ctypes
+import heapq
 import os
-import subprocess
+import stat
+import struct
 import sys
+import tempfile
+import time
 import ext4
+from compact_config import compact_file_contexts, compact_fs_config, read_lines
+from ext4_index import Ext4Index
+
+try:
+  import grp
+  import pwd
+except ImportError:  # Windows
+  grp = pwd = None
+
+
+def skip_lost_found(path, file_type):
+  # lost+found is recreated by mke2fs, it is neither saved nor extracted
+  return path.rsplit('/', 1)[-1] == 'lost+found'
+
+
+class ExternalSort():
+  """
+  Collect lines and return them sorted, keeping at most run_size of them in
+  memory: full runs are sorted and spilled to temporary files, which are
+  merged back with heapq.merge()
+  """
+
+  RUN_SIZE = 100000
+  _LENGTH = struct.Struct('<I')
+
+  def __init__(self, run_size=RUN_SIZE):
+    self.run_size = run_size
+    self.lines = []
+    self.runs = []  # spilled temporary files
+
+  def add(self, line):
+    self.lines.append(line)
+    if len(self.lines) >= self.run_size:
+      self.__spill()
+
+  def __spill(self):
+    # Length-prefixed records: names may contain any character but '/' and NUL
+    self.lines.sort()
+    run = tempfile.TemporaryFile()
+    for line in self.lines:
+      raw = line.encode('utf-8', 'surrogatepass')
+      run.write(self._LENGTH.pack(len(raw)))
+      run.write(raw)
+    run.seek(0)
+    self.runs.append(run)
+    self.lines = []
+
+  def __read_run(self, run):
+    while True:
+      header = run.read(self._LENGTH.size)
+      if not header:
+        break
+      yield run.read(self._LENGTH.unpack(header)[0]).decode('utf-8', 'surrogatepass')
+    run.close()
+
+  def sorted(self):
+    if not self.runs:
+      self.lines.sort()
+      lines, self.lines = self.lines, []
+      return iter(lines)
+
+    if self.lines:
+      self.__spill()
+    runs, self.runs = self.runs, []
+    return heapq.merge(*[self.__read_run(run) for run in runs])
 
 
 class ReadExt4():
-  def __init__(self):
-    self.image_name = os.path.realpath(sys.argv[1])
-    self.out_dir = os.path.realpath(sys.argv[2])
-    self.fs_context = []
-    self.fs_config = []
-    self.fetures = []
+  def __init__(self, image_name, out_dir, use_index=False, hash_content=False, compact=False,
+               use_mmap=True):
+    self.image_name = os.path.realpath(image_name)
+    self.out_dir = os.path.realpath(out_dir)
+    self.use_index = use_index  # read entries from <image>.index.db
+    self.hash_content = hash_content
+    self.compact = compact  # also write subtree rule versions of contexts and config
+    self.use_mmap = use_mmap  # map the image in memory, else read it with pread
+    self.fs_context = ExternalSort()
+    self.fs_config = ExternalSort()
+    self.contexts = {}  # raw security.selinux value -> context
     self.file_name = self.__file_name(os.path.basename(self.image_name))
     self.fs_context_file = os.path.join(
       self.out_dir, self.file_name + "_file_contexts.txt")
@@ -21,6 +97,10 @@ class ReadExt4():
       self.out_dir, self.file_name + '_file_config.txt')
     self.file_features = os.path.join(
       self.out_dir, self.file_name + '_file_features.txt')
+    self.fs_context_compact_file = os.path.join(
+      self.out_dir, self.file_name + '_file_contexts_compact.txt')
+    self.fs_config_compact_file = os.path.join(
+      self.out_dir, self.file_name + '_file_config_compact.txt')
     self.num_files = 0
     self.num_dirs = 0
     self.num_links = 0
@@ -29,198 +109,435 @@ class ReadExt4():
     name = os.path.basename(file_path).split('.')[0]
     return name
 
-  def __get_octal_perm(self, arg):
-    if len(arg) < 9 or len(arg) > 10:
-      return
-    if len(arg) > 8:
-      arg = arg[1:]
-    oor, ow, ox, gr, gw, gx, wr, ww, wx = list(arg)
-    o, g, w, s = 0, 0, 0, 0
-    if oor == 'r':
-      o += 4
-    if ow == 'w':
-      o += 2
-    if ox == 'x':
-      o += 1
-    if ox == 'S':
-      s += 4
-    if ox == 's':
-      s += 4
-      o += 1
-    if gr == 'r':
-      g += 4
-    if gw == 'w':
-      g += 2
-    if gx == 'x':
-      g += 1
-    if gx == 'S':
-      s += 2
-    if gx == 's':
-      s += 2
-      g += 1
-    if wr == 'r':
-      w += 4
-    if ww == 'w':
-      w += 2
-    if wx == 'x':
-      w += 1
-    if wx == 'T':
-      s += 1
-    if wx == 't':
-      s += 1
-      w += 1
-    return str(s) + str(o) + str(g) + str(w)
-
-  def __appendf(self, msg, out_file):
+  def __writef(self, lines, out_file):
     with open(out_file, 'w') as file:
-      file.write('{}\n'.format(msg))
+      for line in lines.sorted():
+        file.write(line + '\n')
+
+  def __escape(self, line):
+    # regex escape of file_contexts: replace . with \. and + with \+
+    return line.replace('.', r'\.').replace('+', r'\+')
 
   def __write_context(self):
     """
     write context from fs_context list to file
     """
     if self.file_name == 'vendor' or self.file_name == 'odm':
-      self.fs_context.append('/ u:object_r:vendor_file:s0')
-      self.fs_context.append(
-        f'/{self.file_name}(/.*)? u:object_r:vendor_file:s0')
-    
+      fixed = ['/ u:object_r:vendor_file:s0',
+               f'/{self.file_name}(/.*)? u:object_r:vendor_file:s0']
     else:
-      self.fs_context.append('/ u:object_r:system_file:s0')
-      self.fs_context.append(
-        f'/{self.file_name}(/.*)? u:object_r:system_file:s0')
+      fixed = ['/ u:object_r:system_file:s0',
+               f'/{self.file_name}(/.*)? u:object_r:system_file:s0']
 
     if self.file_name == 'system':
-      self.fs_context.append(f'/lost+found        u:object_r:rootfs:s0')
+      fixed.append(f'/lost+found        u:object_r:rootfs:s0')
     else:
-      self.fs_context.append(
-        f'/{self.file_name}/lost+found        u:object_r:rootfs:s0')
-
-    # replace . with \. in list
-    self.fs_context = [ele.replace('.', r'\.') for ele in self.fs_context]
-    # replace + with \+ in list
-    self.fs_context = [ele.replace('+', r'\+') for ele in self.fs_context]
-    self.fs_context.sort()
+      fixed.append(f'/{self.file_name}/lost+found        u:object_r:rootfs:s0')
+
+    # entries are escaped by __add_entry, these lines get the same treatment
+    for line in fixed:
+      self.fs_context.add(self.__escape(line))
     # write contexts to file
-    self.__appendf('\n'.join(self.fs_context), self.fs_context_file)
+    self.__writef(self.fs_context, self.fs_context_file)
 
   def __write_config(self):
     """
     write config from fs_config list to file
     """
     if self.file_name == 'vendor':
-      self.fs_config.append('/ 0 2000 0755')
-      self.fs_config.append(f'{self.file_name} 0 2000 0755')
+      self.fs_config.add('/ 0 2000 0755')
+      self.fs_config.add(f'{self.file_name} 0 2000 0755')
     
     else:
-      self.fs_config.append('/ 0 0 0755')
-      self.fs_config.append(f'{self.file_name} 0 0 0755')
+      self.fs_config.add('/ 0 0 0755')
+      self.fs_config.add(f'{self.file_name} 0 0 0755')
 
-    self.fs_config.sort()
     # write config list to file
-    self.__appendf('\n'.join(self.fs_config), self.fs_config_file)
+    self.__writef(self.fs_config, self.fs_config_file)
+
+  def __write_compact(self):
+    """
+    fold the written contexts and config into subtree rules plus exceptions,
+    both are checked to give every path the same label
+    """
+    for compact, in_file, out_file in (
+        (compact_file_contexts, self.fs_context_file, self.fs_context_compact_file),
+        (compact_fs_config, self.fs_config_file, self.fs_config_compact_file)):
+      with open(out_file, 'w') as file:
+        for line in compact(read_lines(in_file)):
+          file.write(line + '\n')
 
   def __write_fetures(self):
-    if os.name == 'posix':
-      cmd = ['tune2fs', '-l', self.image_name]
-      p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT, universal_newlines=True)
-      output, _ = p.communicate()
-
-      with open(self.file_features, 'w') as file:
-        for line in output:
-          file.write(line)
-        file.write('Partition size: {}'.format(
-          os.stat(self.image_name).st_size))
+    # Same lines as `tune2fs -l` but for its "tune2fs <version> (<date>)"
+    # banner, which the tune2fs call that used to write this file captured
+    # with stderr merged into stdout; dump_data() finds values by label
+    with open(self.file_features, 'w') as file:
+      file.write('\n'.join(FsFetures.from_image(self.image_name).lines()) + '\n')
+      file.write('Partition size: {}'.format(
+        os.stat(self.image_name).st_size))
+
+  def visit(self, entry_inode, entry_inode_path):
+    """
+    record config and context of one entry, called for every entry of the walk
+    """
+    mode = entry_inode.inode.i_mode
+    uid = entry_inode.inode.i_uid
+    gid = entry_inode.inode.i_gid
+    con = ''
+
+    # loop over xattr ('security.selinux', b'u:object_r:vendor_file:s0\x00')
+    for i in list(entry_inode.xattrs()):
+      if i[0] == 'security.selinux':
+        # decode each distinct context once
+        con = self.contexts.get(i[1])
+        if con is None:
+          con = i[1].decode('utf-8')  # decode context
+          con = con[:-1]  # remove last car from context '\x00'
+          con = self.contexts[i[1]] = sys.intern(con)
+      else:
+        pass
 
+    if entry_inode.is_dir:
+      self.num_dirs += 1
+    elif entry_inode.is_file:
+      self.num_files += 1
+    elif entry_inode.is_symlink:
+      self.num_links += 1
     else:
-      with open(self.image_name, 'rb') as file:
-        self.fetures.append('Filesystem volume name:'+' '*4 +
-                            ext4.Volume(file).superblock.s_volume_name.decode())
-        self.fetures.append('Last mounted on:'+' '*11 +
-                            ext4.Volume(file).superblock.s_last_mounted.decode())
-        self.fetures.append('Filesystem UUID:'+' '*11 +
-                            ext4.Volume(file).uuid.lower())
-        self.fetures.append('Filesystem magic number:   ' +
-                            hex(ext4.Volume(file).superblock.s_magic))
-        self.fetures.append('Inode count:'+' '*15 +
-                            str(ext4.Volume(file).superblock.s_inodes_count))
-        self.fetures.append('Block size:'+' '*16 +
-                            str(ext4.Volume(file).block_size))
-        self.fetures.append('Inode size:'+' '*16 +
-                            str(ext4.Volume(file).superblock.s_inode_size))
-        self.fetures.append('Inodes per group:'+' '*10 +
-                            str(ext4.Volume(file).superblock.s_inodes_per_group))
-        # write to file
-        self.__appendf('\n'.join(self.fetures), self.file_features)
+      return
 
-  def read_ext4(self):
-    def scan_dir(root_inode, root_path=""):
-      for entry_name, entry_inode_idx, entry_type in root_inode.open_dir():
-        # exclude '.', '..'
-        if entry_name in ['.', '..', 'lost+found']:
-          continue
-
-        entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
-        entry_inode_path = root_path + '/' + entry_name
-        mode = self.__get_octal_perm(entry_inode.mode_str)
-        uid = entry_inode.inode.i_uid
-        gid = entry_inode.inode.i_gid
-        con = ''
-
-        # loop over xattr ('security.selinux', b'u:object_r:vendor_file:s0\x00')
-        for i in list(entry_inode.xattrs()):
-          if i[0] == 'security.selinux':
-            con = i[1].decode('utf-8')  # decode context
-            con = con[:-1]  # remove last car from context '\x00'
-          else:
-            pass
-
-        file_name_context = '/'+self.file_name + entry_inode_path
-        file_name_config = self.file_name + entry_inode_path
-        if self.file_name == 'system':
-          file_name_context = entry_inode_path
-          file_name_config = entry_inode_path[entry_inode_path.startswith(
-            '/') and len('/'):]
-
-        if entry_inode.is_dir:
-          self.num_dirs += 1
-          scan_dir(entry_inode, entry_inode_path)  # loop inside the directory
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
-          self.fs_context.append(f'{file_name_context} {con}')
-
-        elif entry_inode.is_file:
-          self.num_files += 1
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
-          self.fs_context.append(f'{file_name_context} {con}')
-
-        elif entry_inode.is_symlink:
-          self.num_links += 1
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
-          self.fs_context.append(f'{file_name_context} {con}')
+    self.__add_entry(entry_inode_path, uid, gid, mode, con)
 
-    # open image
-    with open(self.image_name, 'rb') as file:
-      root = ext4.Volume(file).root
-      scan_dir(root)
+  def visit_index_entry(self, entry):
+    """
+    same as visit() for an entry of the image index
+    """
+    if stat.S_ISDIR(entry.mode):
+      self.num_dirs += 1
+    elif stat.S_ISREG(entry.mode):
+      self.num_files += 1
+    elif stat.S_ISLNK(entry.mode):
+      self.num_links += 1
+    else:
+      return
 
+    con = ''
+    if entry.context is not None:
+      con = self.contexts.get(entry.context)
+      if con is None:
+        # remove last car from context '\x00', as visit() does
+        con = self.contexts[entry.context] = sys.intern(entry.context[:-1])
+    self.__add_entry(entry.path, entry.uid, entry.gid, entry.mode, con)
+
+  def __add_entry(self, entry_inode_path, uid, gid, mode, con):
+    file_name_context = '/'+self.file_name + entry_inode_path
+    file_name_config = self.file_name + entry_inode_path
+    if self.file_name == 'system':
+      file_name_context = entry_inode_path
+      file_name_config = entry_inode_path[entry_inode_path.startswith(
+        '/') and len('/'):]
+
+    # permission and special bits of i_mode, as the mode column of fs_config
+    self.fs_config.add(f'{file_name_config} {uid} {gid} {mode & 0o7777:04o}')
+    self.fs_context.add(self.__escape(f'{file_name_context} {con}'))
+
+  def finish(self):
+    """
+    write contexts, config and features collected by visit()
+    """
     self.__write_context()
     self.__write_config()
+    if self.compact:
+      self.__write_compact()
     self.__write_fetures()
+
+  def read_ext4(self):
+    if self.use_index:
+      # (re)build the index only if the image changed, then read it alone
+      with Ext4Index(self.image_name, use_mmap=self.use_mmap).open(self.hash_content) as index:
+        for entry in index.entries():
+          if entry.path != '/' and 'lost+found' not in entry.path.split('/'):
+            self.visit_index_entry(entry)
+
+      self.finish()
+      print(f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS')
+      return
+
+    # open image
+    with open(self.image_name, 'rb') as file:
+      with ext4.Volume(file, use_mmap=self.use_mmap) as volume:
+        for path, inode_idx, _, inode in volume.walk(exclude=skip_lost_found):
+          self.visit(inode(), path)
+
+    self.finish()
     print(f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS')
 
 
 class FsFetures():
-  def __init__(self):
-    pass
+  """
+  Superblock listing in the format of `tune2fs -l` (list_super2() of
+  e2fsprogs' libe2p), built from one raw read of the superblock
+  """
+
+  # feature bit -> name, in the order tune2fs prints them
+  COMPAT = {0x1: 'dir_prealloc', 0x2: 'imagic_inodes', 0x4: 'has_journal', 0x8: 'ext_attr',
+            0x10: 'resize_inode', 0x20: 'dir_index', 0x40: 'lazy_bg', 0x100: 'snapshot_bitmap',
+            0x200: 'sparse_super2', 0x400: 'fast_commit', 0x800: 'stable_inodes',
+            0x1000: 'orphan_file'}
+  INCOMPAT = {0x1: 'compression', 0x2: 'filetype', 0x4: 'needs_recovery', 0x8: 'journal_dev',
+              0x10: 'meta_bg', 0x40: 'extent', 0x80: '64bit', 0x100: 'mmp', 0x200: 'flex_bg',
+              0x400: 'ea_inode', 0x1000: 'dirdata', 0x2000: 'metadata_csum_seed',
+              0x4000: 'large_dir', 0x8000: 'inline_data', 0x10000: 'encrypt',
+              0x20000: 'casefold'}
+  RO_COMPAT = {0x1: 'sparse_super', 0x2: 'large_file', 0x8: 'huge_file', 0x10: 'uninit_bg',
+               0x20: 'dir_nlink', 0x40: 'extra_isize', 0x80: 'snapshot_klist', 0x100: 'quota',
+               0x200: 'bigalloc', 0x400: 'metadata_csum', 0x800: 'replica', 0x1000: 'read-only',
+               0x2000: 'project', 0x4000: 'shared_blocks', 0x8000: 'verity',
+               0x10000: 'orphan_present'}
+  MOUNT_OPTIONS = {0x1: 'debug', 0x2: 'bsdgroups', 0x4: 'user_xattr', 0x8: 'acl', 0x10: 'uid16',
+                   0x20: 'journal_data', 0x40: 'journal_data_ordered',
+                   0x60: 'journal_data_writeback', 0x100: 'nobarrier', 0x200: 'block_validity',
+                   0x400: 'discard', 0x800: 'nodelalloc'}
+  MOUNT_JOURNAL_MODE = 0x60
+  OS_TYPES = ['Linux', 'Hurd', 'Masix', 'FreeBSD', 'Lites']
+  ERRORS = {1: 'Continue', 2: 'Remount read-only', 3: 'Panic'}
+  HASHES = ['legacy', 'half_md4', 'tea']
+
+  def __init__(self, superblock):
+    self.sb = superblock
+
+  @classmethod
+  def from_image(cls, image_name):
+    with open(image_name, 'rb') as file:
+      file.seek(0x400)
+      return cls(ext4.ext4_superblock.from_buffer_copy(file.read(ctypes.sizeof(ext4.ext4_superblock))))
+
+  def __uuid(self, raw):
+    raw = bytes(raw)
+    if not any(raw):
+      return '<none>'
+    return '-'.join(raw[start:end].hex() for start, end in ((0, 4), (4, 6), (6, 8), (8, 10), (10, 16)))
+
+  def __str(self, raw):
+    return bytes(raw).split(b'\0')[0].decode('utf-8', 'replace')
+
+  def __time(self, value):
+    return time.ctime(value)
+
+  def __blocks(self, lo, hi):
+    return lo | (hi << 32 if self.sb.s_feature_incompat & 0x80 else 0)
+
+  def __features(self):
+    names = []
+    for char, mask, table in (('C', self.sb.s_feature_compat, self.COMPAT),
+                              ('I', self.sb.s_feature_incompat, self.INCOMPAT),
+                              ('R', self.sb.s_feature_ro_compat, self.RO_COMPAT)):
+      for bit in range(32):
+        if mask & (1 << bit):
+          names.append(table.get(1 << bit, f'FEATURE_{char}{bit}'))
+    return ' '.join(names) if names else '(none)'
+
+  def __flags(self):
+    flags = ''
+    for flag, name in ((0x1, 'signed_directory_hash '), (0x2, 'unsigned_directory_hash '),
+                       (0x4, 'test_filesystem ')):
+      if self.sb.s_flags & flag:
+        flags += name
+    return flags or '(none)'
+
+  def __mount_options(self):
+    mask = self.sb.s_default_mount_opts
+    names = []
+    if mask & self.MOUNT_JOURNAL_MODE:
+      names.append(self.MOUNT_OPTIONS[mask & self.MOUNT_JOURNAL_MODE])
+    for bit in range(32):
+      if mask & (1 << bit) and not (1 << bit) & self.MOUNT_JOURNAL_MODE:
+        names.append(self.MOUNT_OPTIONS.get(1 << bit, f'MNTOPT_{bit}'))
+    return ' '.join(names) if names else '(none)'
+
+  def __interval(self, secs):
+    if secs == 0:
+      return '<none>'
+
+    parts = []
+    for length, unit in ((86400 * 30, 'month'), (86400 * 7, 'week'), (86400, 'day')):
+      if secs >= length:
+        num, secs = divmod(secs, length)
+        parts.append(f'{num} {unit}' + ('s' if num > 1 else ''))
+    if secs > 0:
+      parts.append('{:d}:{:02d}:{:02d}'.format(secs // 3600, secs % 3600 // 60, secs % 60))
+    return ', '.join(parts)
+
+  def __kbytes(self, kbytes):
+    for shift, unit in ((0, 'kB'), (10, 'MB'), (20, 'GB'), (30, 'TB')):
+      if kbytes < 1 << (shift + 13):
+        return '{} {}'.format((kbytes + (1 << shift >> 1)) >> shift if shift else kbytes, unit)
+    return '{} PB'.format((kbytes + (1 << 39)) >> 40)
+
+  def __owner(self, owner_id, module, kind):
+    try:
+      name = module.getpwuid(owner_id).pw_name if kind == 'user' else module.getgrgid(owner_id).gr_name
+    except (AttributeError, KeyError):
+      return f'{owner_id} ({kind} unknown)'
+    return f'{owner_id} ({kind} {name})'
+
+  def lines(self):
+    sb = self.sb
+    block_size = 1024 << sb.s_log_block_size
+    bigalloc = sb.s_feature_ro_compat & 0x200
+    lines = []
+
+    def add(label, value):
+      lines.append('{:<26}{}'.format(label + ':', value))
+
+    add('Filesystem volume name', self.__str(sb.s_volume_name) or '<none>')
+    add('Last mounted on', self.__str(sb.s_last_mounted) or '<not available>')
+    add('Filesystem UUID', self.__uuid(sb.s_uuid))
+    add('Filesystem magic number', '0x{:04X}'.format(sb.s_magic))
+    add('Filesystem revision #', '{} ({})'.format(
+      sb.s_rev_level, {0: 'original', 1: 'dynamic'}.get(sb.s_rev_level, 'unknown')))
+    add('Filesystem features', self.__features())
+    add('Filesystem flags', self.__flags())
+    add('Default mount options', self.__mount_options())
+    if self.__str(sb.s_mount_opts):
+      add('Mount options', self.__str(sb.s_mount_opts))
+    add('Filesystem state', ('clean' if sb.s_state & 0x1 else 'not clean') +
+        (' with errors' if sb.s_state & 0x2 else ''))
+    add('Errors behavior', self.ERRORS.get(sb.s_errors, 'Unknown (continue)'))
+    add('Filesystem OS type', self.OS_TYPES[sb.s_creator_os]
+        if sb.s_creator_os < len(self.OS_TYPES) else '(unknown os)')
+    add('Inode count', sb.s_inodes_count)
+    add('Block count', self.__blocks(sb.s_blocks_count_lo, sb.s_blocks_count_hi))
+    add('Reserved block count', self.__blocks(sb.s_r_blocks_count_lo, sb.s_r_blocks_count_hi))
+    if sb.s_overhead_blocks:
+      add('Overhead clusters', sb.s_overhead_blocks)
+    add('Free blocks', self.__blocks(sb.s_free_blocks_count_lo, sb.s_free_blocks_count_hi))
+    add('Free inodes', sb.s_free_inodes_count)
+    add('First block', sb.s_first_data_block)
+    add('Block size', block_size)
+    add('Cluster size' if bigalloc else 'Fragment size', 1024 << sb.s_log_cluster_size)
+    if sb.s_feature_incompat & 0x80:
+      add('Group descriptor size', sb.s_desc_size)
+    if sb.s_reserved_gdt_blocks:
+      add('Reserved GDT blocks', sb.s_reserved_gdt_blocks)
+    add('Blocks per group', sb.s_blocks_per_group)
+    add('Clusters per group' if bigalloc else 'Fragments per group', sb.s_clusters_per_group)
+    add('Inodes per group', sb.s_inodes_per_group)
+    add('Inode blocks per group',
+        (sb.s_inodes_per_group * sb.s_inode_size + block_size - 1) // block_size)
+    if sb.s_raid_stride:
+      add('RAID stride', sb.s_raid_stride)
+    if sb.s_raid_stripe_width:
+      add('RAID stripe width', sb.s_raid_stripe_width)
+    if sb.s_first_meta_bg:
+      add('First meta block group', sb.s_first_meta_bg)
+    if sb.s_log_groups_per_flex:
+      add('Flex block group size', 1 << sb.s_log_groups_per_flex)
+    if sb.s_mkfs_time:
+      add('Filesystem created', self.__time(sb.s_mkfs_time))
+    add('Last mount time', self.__time(sb.s_mtime) if sb.s_mtime else 'n/a')
+    add('Last write time', self.__time(sb.s_wtime))
+    add('Mount count', sb.s_mnt_count)
+    add('Maximum mount count', ctypes.c_short(sb.s_max_mnt_count).value)
+    add('Last checked', self.__time(sb.s_lastcheck))
+    add('Check interval', '{} ({})'.format(sb.s_checkinterval, self.__interval(sb.s_checkinterval)))
+    if sb.s_checkinterval:
+      add('Next check after', self.__time(sb.s_lastcheck + sb.s_checkinterval))
+    if sb.s_kbytes_written:
+      add('Lifetime writes', self.__kbytes(sb.s_kbytes_written))
+    add('Reserved blocks uid', self.__owner(sb.s_def_resuid, pwd, 'user'))
+    add('Reserved blocks gid', self.__owner(sb.s_def_resgid, grp, 'group'))
+    if sb.s_rev_level >= 1:
+      add('First inode', sb.s_first_ino)
+      lines.append('Inode size:\t          {}'.format(sb.s_inode_size))  # sic, as tune2fs
+      if sb.s_min_extra_isize:
+        add('Required extra isize', sb.s_min_extra_isize)
+      if sb.s_want_extra_isize:
+        add('Desired extra isize', sb.s_want_extra_isize)
+    if any(sb.s_journal_uuid):
+      add('Journal UUID', self.__uuid(sb.s_journal_uuid))
+    if sb.s_journal_inum:
+      add('Journal inode', sb.s_journal_inum)
+    if sb.s_journal_dev:
+      lines.append('Journal device:\t          0x{:04x}'.format(sb.s_journal_dev))
+    if sb.s_last_orphan:
+      add('First orphan inode', sb.s_last_orphan)
+    if sb.s_feature_compat & 0x20 or sb.s_def_hash_version:
+      add('Default directory hash', self.HASHES[sb.s_def_hash_version]
+          if sb.s_def_hash_version < len(self.HASHES) else f'HASHALG_{sb.s_def_hash_version}')
+    if any(bytes(sb.s_hash_seed)):
+      add('Directory Hash Seed', self.__uuid(sb.s_hash_seed))
+    if sb.s_jnl_backup_type:
+      add('Journal backup', 'inode blocks' if sb.s_jnl_backup_type == 1
+          else f'type {sb.s_jnl_backup_type}')
+    if sb.s_backup_bgs[0] or sb.s_backup_bgs[1]:
+      add('Backup block groups', ''.join(f'{group} ' for group in sb.s_backup_bgs if group))
+    if sb.s_snapshot_inum:
+      add('Snapshot inode', sb.s_snapshot_inum)
+      add('Snapshot ID', sb.s_snapshot_id)
+      add('Snapshot reserved blocks', sb.s_snapshot_r_blocks_count)
+    if sb.s_snapshot_list:
+      add('Snapshot list head', sb.s_snapshot_list)
+    if sb.s_error_count:
+      add('FS Error count', sb.s_error_count)
+    for which, error_time, func, line, ino, block in (
+        ('First', sb.s_first_error_time, sb.s_first_error_func, sb.s_first_error_line,
+         sb.s_first_error_ino, sb.s_first_error_block),
+        ('Last', sb.s_last_error_time, sb.s_last_error_func, sb.s_last_error_line,
+         sb.s_last_error_ino, sb.s_last_error_block)):
+      if error_time:
+        add(f'{which} error time', self.__time(error_time))
+        add(f'{which} error function', self.__str(func))
+        add(f'{which} error line #', line)
+        if ino:
+          add(f'{which} error inode #', ino)
+        if block:
+          add(f'{which} error block #', block)
+    if sb.s_feature_incompat & 0x100:
+      add('MMP block number', sb.s_mmp_block)
+      add('MMP update interval', sb.s_mmp_interval)
+    for label, inum in (('User quota inode', sb.s_usr_quota_inum),
+                        ('Group quota inode', sb.s_grp_quota_inum),
+                        ('Project quota inode', sb.s_prj_quota_inum)):
+      if inum:
+        add(label, inum)
+    if sb.s_feature_ro_compat & 0x400:
+      add('Checksum type', 'crc32c' if sb.s_checksum_type == 1 else 'unknown')
+      add('Checksum', '0x{:08x}'.format(sb.s_checksum))
+    if any(sb.s_encrypt_pw_salt):
+      add('Encryption PW Salt', self.__uuid(sb.s_encrypt_pw_salt))
+    if sb.s_feature_incompat & 0x2000:
+      add('Checksum seed', '0x{:08x}'.format(sb.s_checksum_seed))
+
+    return lines
+
+
+def parser():
+  parser = argparse.ArgumentParser(
+    description='Save file_config, file_contexts and file_features of ext4 image')
+  parser.add_argument('image', help='ext4 image')
+  parser.add_argument('info', help='Specify information directory')
+  parser.add_argument('-x', '--index', dest='use_index', action='store_true',
+                      help='Keep an index next to the image (<image>.index.db) '
+                           'and read it instead of the image while it is up to date')
+  parser.add_argument('--hash', dest='hash_content', action='store_true',
+                      help='Store a SHA-256 of every file in the index with [-x]')
+  parser.add_argument('-c', '--compact', action='store_true',
+                      help='Also write file_contexts and file_config folded into '
+                           'subtree rules plus exceptions (*_compact.txt)')
+  parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                      help='Read the image with pread instead of mapping it in memory')
+  return parser
 
 
 if __name__ == '__main__':
-  if sys.argv.__len__() < 3:
-    print(f'USAGE: {sys.argv[0]} image_path info_path')
-  else:
-    print(
-      f':: Save Information {ReadExt4().file_name}.img...',
-      f':: Image path -> {ReadExt4().image_name}',
-      f':: Info dir   -> {ReadExt4().out_dir}',
-      sep='\n', end='\n\n')
-    ReadExt4().read_ext4()
+  args = parser().parse_args()
+  reader = ReadExt4(args.image, args.info,
+                    use_index=args.use_index, hash_content=args.hash_content,
+                    compact=args.compact, use_mmap=args.use_mmap)
+  print(
+    f':: Save Information {reader.file_name}.img...',
+    f':: Image path -> {reader.image_name}',
+    f':: Info dir   -> {reader.out_dir}',
+    sep='\n', end='\n\n')
+  reader.read_ext4()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import errno
+import fnmatch
+import io
+import os
+import posixpath
+import stat
+
+import ext4
+
+
+class Ext4Path():
+  """
+  Read-only pathlib.Path look-alike for the files of an ext4 image, so that
+  scripts can inspect an image without extracting it:
+
+    with open('system.img', 'rb') as file, ext4.Volume(file, use_mmap=True) as volume:
+      root = Ext4Path(volume)
+      prop = (root / 'system' / 'build.prop').read_text()
+      apks = list(root.glob('system/app/*/*.apk'))
+
+  Paths are absolute inside the image. Names are resolved through
+  Volume.lookup(), which caches directory entries and uses hash tree indexes.
+  Like pathlib, stat(), open() and the is_*() tests follow symbolic links
+  (in the image, so absolute links resolve from the image root) while
+  lstat(), readlink() and is_symlink() don't.
+  """
+
+  MAX_SYMLINKS = 40  # same limit as Linux before ELOOP
+
+  def __init__(self, volume, *pathsegments):
+    self.volume = volume
+    self.path = posixpath.normpath(posixpath.join('/', *pathsegments))
+    if self.path.startswith('//'):
+      self.path = self.path[1:]
+    self._entry = None  # (inode_idx, file_type) of the path itself, once known
+
+  def __repr__(self):
+    return "{type_name:s}({path!r:s})".format(path=self.path, type_name=type(self).__name__)
+
+  def __str__(self):
+    return self.path
+
+  def __eq__(self, other):
+    if not isinstance(other, Ext4Path):
+      return NotImplemented
+    return self.volume is other.volume and self.path == other.path
+
+  def __hash__(self):
+    return hash(self.path)
+
+  def __lt__(self, other):
+    return self.path < other.path
+
+  def __truediv__(self, other):
+    return self.joinpath(other)
+
+  @property
+  def name(self):
+    return posixpath.basename(self.path)
+
+  @property
+  def parent(self):
+    return Ext4Path(self.volume, posixpath.dirname(self.path))
+
+  @property
+  def parts(self):
+    return ('/',) + tuple(part for part in self.path.split('/') if part)
+
+  @property
+  def stem(self):
+    return posixpath.splitext(self.name)[0]
+
+  @property
+  def suffix(self):
+    return posixpath.splitext(self.name)[1]
+
+  def joinpath(self, *other):
+    return Ext4Path(self.volume, self.path, *[str(part) for part in other])
+
+  def _child(self, name, inode_idx, file_type):
+    child = Ext4Path(self.volume, self.path, name)
+    child._entry = (inode_idx, file_type)
+    return child
+
+  def _error(self, error_class, code):
+    return error_class(code, os.strerror(code), self.path)
+
+  def _resolve(self, follow_symlinks):
+    # Walk the path from the root to its Inode, following symbolic links in
+    # the directories on the way and, if asked to, in the last component
+    if self._entry is not None and not follow_symlinks:
+      return self.volume.get_inode(*self._entry)
+
+    inode = self.volume.root
+    parts = list(reversed(self.parts[1:]))
+    num_links = 0
+
+    while parts:
+      part = parts.pop()
+      if part == '.':
+        continue
+
+      inode_idx, file_type = self.volume.lookup(inode, part)
+      if inode_idx is None:
+        raise self._error(FileNotFoundError, errno.ENOENT)
+
+      entry_inode = self.volume.get_inode(inode_idx, file_type)
+
+      if stat.S_ISLNK(entry_inode.inode.i_mode) and (parts or follow_symlinks):
+        num_links += 1
+        if num_links > self.MAX_SYMLINKS:
+          raise self._error(OSError, errno.ELOOP)
+
+        target = entry_inode.open_read().read().decode('utf8')
+        if target.startswith('/'):
+          inode = self.volume.root
+        parts.extend(reversed([part for part in target.split('/') if part]))
+        continue
+
+      if parts and not stat.S_ISDIR(entry_inode.inode.i_mode):
+        raise self._error(NotADirectoryError, errno.ENOTDIR)
+
+      inode = entry_inode
+
+    if not follow_symlinks:
+      self._entry = (inode.inode_idx, inode.file_type)
+
+    return inode
+
+  def inode(self, follow_symlinks=True):
+    return self._resolve(follow_symlinks)
+
+  def stat(self, follow_symlinks=True):
+    inode = self._resolve(follow_symlinks)
+    raw = inode.inode
+
+    return os.stat_result((raw.i_mode, inode.inode_idx, 0, raw.i_links_count,
+                           raw.i_uid, raw.i_gid, len(inode),
+                           raw.i_atime, raw.i_mtime, raw.i_ctime))
+
+  def lstat(self):
+    return self.stat(follow_symlinks=False)
+
+  def exists(self):
+    try:
+      self._resolve(True)
+    except OSError:
+      return False
+    return True
+
+  def __test_mode(self, test, follow_symlinks=True):
+    try:
+      return test(self._resolve(follow_symlinks).inode.i_mode)
+    except OSError:
+      return False
+
+  def is_dir(self):
+    return self.__test_mode(stat.S_ISDIR)
+
+  def is_file(self):
+    return self.__test_mode(stat.S_ISREG)
+
+  def is_symlink(self):
+    return self.__test_mode(stat.S_ISLNK, follow_symlinks=False)
+
+  def iterdir(self):
+    inode = self._resolve(True)
+    if not stat.S_ISDIR(inode.inode.i_mode):
+      raise self._error(NotADirectoryError, errno.ENOTDIR)
+
+    for entry_name, entry_inode_idx, entry_type in inode.open_dir():
+      if entry_inode_idx == 0 or entry_name in ('.', '..'):
+        continue
+      yield self._child(entry_name, entry_inode_idx, entry_type)
+
+  def glob(self, pattern):
+    # Component-wise fnmatch, '**' matches this directory and all below it
+    parts = [part for part in pattern.split('/') if part]
+    if not parts:
+      raise ValueError("Unacceptable pattern: {0!r:s}".format(pattern))
+
+    seen = set()
+    for path in self.__select(parts):
+      if path.path not in seen:
+        seen.add(path.path)
+        yield path
+
+  def rglob(self, pattern):
+    return self.glob('**/' + pattern)
+
+  def __select(self, parts):
+    if not parts:
+      yield self
+      return
+
+    part, rest = parts[0], parts[1:]
+
+    if part == '**':
+      if self.is_dir():
+        yield from self.__select(rest)
+        for path, inode_idx, file_type, _ in self.volume.walk(top=self._resolve(True)):
+          if file_type == ext4.InodeType.DIRECTORY:
+            yield from self._child(path[1:], inode_idx, file_type).__select(rest)
+    elif not any(c in part for c in '*?['):
+      # Plain name: one cached lookup instead of listing the directory
+      child = self / part
+      if rest:
+        if child.is_dir():
+          yield from child.__select(rest)
+      elif child.exists() or child.is_symlink():
+        yield child
+    elif self.is_dir():
+      for child in self.iterdir():
+        if fnmatch.fnmatchcase(child.name, part):
+          if not rest:
+            yield child
+          elif child.is_dir():
+            yield from child.__select(rest)
+
+  def open(self, mode='r', buffering=-1, encoding=None, errors=None, newline=None):
+    if mode not in ('r', 'rb', 'rt'):
+      raise ValueError("Invalid mode: {0!r:s} (the image is read-only)".format(mode))
+
+    inode = self._resolve(True)
+    if stat.S_ISDIR(inode.inode.i_mode):
+      raise self._error(IsADirectoryError, errno.EISDIR)
+
+    reader = inode.open_read()
+    if isinstance(reader, ext4.BlockReader) and buffering != 0:
+      reader = io.BufferedReader(
+        reader, buffering if buffering > 1 else ext4.Inode.CHUNK_SIZE)
+
+    if 'b' in mode:
+      return reader
+    return io.TextIOWrapper(reader, encoding or 'utf-8', errors, newline)
+
+  def read_bytes(self):
+    with self.open('rb', buffering=0) as file:
+      return file.read()
+
+  def read_text(self, encoding=None, errors=None):
+    with self.open('r', encoding=encoding, errors=errors) as file:
+      return file.read()
+
+  def readlink(self):
+    # Target of a symbolic link, exactly as stored in the image
+    inode = self._resolve(False)
+    if not stat.S_ISLNK(inode.inode.i_mode):
+      raise self._error(OSError, errno.EINVAL)
+    return inode.open_read().read().decode('utf8')
@@ -1,86 +1,489 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import collections
+import fnmatch
+import functools
+import hashlib
+import json
 import os
-import sys
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import ext4
+from ext4_index import Ext4Index
+from ext4_info import skip_lost_found
+
+
+class PathMatcher():
+  """
+  Match image paths ("/etc/selinux/...") against glob patterns relative to
+  the image root, one path component at a time. A pattern selects the
+  matching entries with everything below them; directories on the way to
+  a possible match are kept so that only those are descended into.
+  """
+
+  def __init__(self, patterns):
+    self.patterns = []
+    for pattern in patterns:
+      parts = [part for part in pattern.strip().split('/') if part]
+      if parts:
+        self.patterns.append([re.compile(fnmatch.translate(part)).match for part in parts])
+
+  def __call__(self, path, file_type):
+    parts = path.lstrip('/').split('/')
+
+    for pattern in self.patterns:
+      if all(match(part) for match, part in zip(pattern, parts)):
+        if len(parts) >= len(pattern):
+          return True  # matched, or below a matched directory
+        if file_type in (ext4.InodeType.DIRECTORY, ext4.InodeType.UNKNOWN):
+          return True  # may lead to a match
+
+    return False
+
+
+def load_path_list(list_file):
+  # One path or glob pattern per line, blank lines and '#' comments ignored
+  with open(list_file) as file:
+    lines = [line.strip() for line in file]
+  return [line for line in lines if line and not line.startswith('#')]
+
+
+class ExtractManifest():
+  """
+  Append-only JSON lines record of an extraction into a directory, one
+  line {"path": ..., "type": ...} per finished entry, the last line of a
+  path wins. The next extraction uses it to skip unchanged files, delete
+  the entries gone from the image and resume after an interruption.
+  close() compacts it to one line per entry.
+  """
+
+  def __init__(self, manifest_file):
+    self.manifest_file = manifest_file
+    self.previous = {}  # path -> record of the earlier runs
+    self.current = {}  # path -> record of this run
+    self.lock = threading.Lock()
+
+    if os.path.isfile(manifest_file):
+      with open(manifest_file) as file:
+        for line in file:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            continue  # torn last line of an interrupted run
+          self.previous[record['path']] = record
+
+    self.file = open(manifest_file, 'a')
+
+  def get(self, path):
+    return self.previous.get(path)
+
+  def add(self, record):
+    with self.lock:
+      self.current[record['path']] = record
+      self.file.write(json.dumps(record) + '\n')
+
+  def removed(self):
+    # records of the earlier runs not seen by this one
+    return [record for path, record in self.previous.items() if path not in self.current]
+
+  def close(self, keep_removed=False):
+    self.file.close()
+
+    records = dict(self.previous) if keep_removed else {}
+    records.update(self.current)
+    with open(self.manifest_file + '.tmp', 'w') as file:
+      for path in sorted(records):
+        file.write(json.dumps(records[path]) + '\n')
+    os.replace(self.manifest_file + '.tmp', self.manifest_file)
 
 
 class ExtractExt4():
-  def __init__(self):
-    self.image_name = os.path.realpath(sys.argv[1])
+  # Output files kept open at once while sweeping the image in physical order
+  MAX_OPEN_FILES = 256
+  # Forward skips up to this size still count as sequential (readahead window)
+  SEQUENTIAL_GAP = 128 * 1024
+
+  def __init__(self, image_name, out_dir, zero_copy=False, workers=1, order='directory', patterns=None,
+               manifest=None, use_mmap=True, use_index=False):
+    self.image_name = os.path.realpath(image_name)
     self.file_name = self.__file_name(os.path.basename(self.image_name))
-    self.out_dir = os.path.realpath(sys.argv[2])
+    self.out_dir = os.path.realpath(out_dir)
+    self.zero_copy = zero_copy
+    self.workers = workers or os.cpu_count()
+    self.order = order
+    # map the image in memory, else read it with pread. The thread pool always
+    # reads with pread/preadv, which release the GIL: copies out of the
+    # mapping and the page faults they take hold it, serializing the workers
+    self.use_mmap = use_mmap and (self.workers == 1 or order == 'physical')
+    # extract only the paths matching these globs, everything if None
+    self.include = PathMatcher(patterns) if patterns else None
+    # plan the extraction from <image>.index.db instead of walking the image
+    self.use_index = use_index
+    self.extents = {}  # inode_idx -> extent runs from the index, for physical order
+    # skip files unchanged since the extraction recorded in this manifest
+    self.manifest = ExtractManifest(manifest) if manifest else None
+    self.num_unchanged = 0
+    self.num_removed = 0
     self.num_files = 0
     self.num_dirs = 0
     self.num_links = 0
+    self.num_hardlinks = 0
+    self.first_links = {}  # inode_idx -> first file_target of a multiply linked inode
+    self.hardlinks = []  # (first file_target, file_target) made with os.link by finish()
+    # (file_target, inode_idx, file_type, fingerprint) of every regular file,
+    # copied by finish() once the walk has created all directories and symlinks
+    self.work = []
 
   def __file_name(self, file_path):
     name = os.path.basename(file_path).split('.')[0]
     return name
 
-  def extract_ext4(self):
+  def __remove_target(self, target):
+    # Clear the way for a new entry, whatever an older image left there
+    if os.path.isdir(target) and not os.path.islink(target):
+      shutil.rmtree(target)
+    elif os.path.lexists(target):
+      os.remove(target)
+
+  def __open_target(self, file_target):
+    # Replace rather than truncate, the old file may be linked to another name
+    self.__remove_target(file_target)
+    return open(file_target, 'wb')
+
+  def __extract_file(self, volume, file_target, inode_idx, file_type, fingerprint):
+    # Returns False if the file already had the content and was left alone
+    entry_inode = volume.get_inode(inode_idx, file_type)
+
+    copied = fingerprint is None or not self.__same_content(entry_inode, file_target)
+    if copied:
+      # stream file content to new file
+      with self.__open_target(file_target) as out:
+        if self.zero_copy:
+          entry_inode.copy_to_fd(out.fileno())
+        else:
+          entry_inode.copy_to(out)
+
+    if self.manifest is not None:
+      self.__record_file(file_target, fingerprint)
+    return copied
+
+  def __fingerprint(self, entry_inode):
+    # Image, size, mtime and extents of a file: equal fingerprints within the
+    # same image mean equal content. The image UUID has to stay: images are
+    # usually built with a fixed mtime for every file, so a file edited to the
+    # same size keeps the other fields and only the content compare sees it
+    sha1 = hashlib.sha1(entry_inode.volume.uuid.encode())
+    sha1.update('{0:d}:{1:d}:'.format(len(entry_inode), entry_inode.inode.i_mtime).encode())
+
+    reader = entry_inode.open_read()
+    if isinstance(reader, ext4.BlockReader):
+      for column in (reader.file_blocks, reader.disk_blocks, reader.block_counts):
+        sha1.update(column.tobytes())
+    else:
+      sha1.update(reader.getvalue())
+
+    return sha1.hexdigest()
+
+  def __same_content(self, entry_inode, file_target):
+    # Compare the extracted file with the image, to avoid rewriting files
+    # that are unchanged in a newer image
+    try:
+      if os.lstat(file_target).st_size != len(entry_inode):
+        return False
+    except OSError:
+      return False
+
+    with open(file_target, 'rb') as file:
+      for chunk in entry_inode.iter_chunks():
+        if file.read(len(chunk)) != chunk:
+          return False
+
+    return True
+
+  def __record(self, target, entry_type, **fields):
+    self.manifest.add(dict(path=target[len(self.out_dir):], type=entry_type, **fields))
+
+  def __record_file(self, file_target, fingerprint):
+    st = os.lstat(file_target)
+    self.__record(file_target, 'file', fingerprint=fingerprint,
+                  size=st.st_size, mtime_ns=st.st_mtime_ns)
 
-    def scan_dir(root_inode, root_path=""):
-      for entry_name, entry_inode_idx, entry_type in root_inode.open_dir():
-        # exclude '.', '..'
-        if entry_name in ['.', '..', 'lost+found']:
+  def __unchanged(self, file_target, fingerprint):
+    # Same fingerprint as recorded and the file left as it was written
+    record = self.manifest.get(file_target[len(self.out_dir):])
+    if record is None or record['type'] != 'file' or record['fingerprint'] != fingerprint:
+      return False
+
+    try:
+      st = os.lstat(file_target)
+    except OSError:
+      return False
+    return st.st_size == record['size'] and st.st_mtime_ns == record['mtime_ns']
+
+  def __remove_old_entries(self):
+    # Delete what earlier extractions wrote and the image no longer has
+    dirs = []
+    for record in self.manifest.removed():
+      target = self.out_dir + record['path']
+      if record['type'] == 'dir':
+        dirs.append(target)
+      elif os.path.lexists(target):
+        os.remove(target)
+      self.num_removed += 1
+
+    for dir_target in sorted(dirs, reverse=True):
+      try:
+        os.rmdir(dir_target)
+      except OSError:
+        pass  # not empty: still holds files not made by the extraction
+
+  def __open_read(self, entry_inode):
+    # Reader built from the extent map of the index if it has one, which
+    # spares reading the extent tree
+    runs = self.extents.get(entry_inode.inode_idx)
+    if runs is None:
+      return entry_inode.open_read()
+    return ext4.BlockReader(entry_inode.volume, len(entry_inode),
+                            [ext4.MappingEntry(*run) for run in runs])
+
+  def __sequentiality(self, runs):
+    # Share of reads that continue (or skip slightly forward from) the
+    # previous one, for runs given as (disk_offset, ..., byte_len)
+    sequential = 0
+    prev_end = None
+
+    for run in runs:
+      if prev_end is not None and 0 <= run[0] - prev_end <= self.SEQUENTIAL_GAP:
+        sequential += 1
+      prev_end = run[0] + run[-1]
+
+    return sequential / (len(runs) - 1) if len(runs) > 1 else 1.0
+
+  def __extract_physical(self, volume, work):
+    # Create every output file first, then copy all extent runs sorted by
+    # their position in the image so that it is read in one forward sweep
+    runs = []
+
+    for file_idx, (file_target, inode_idx, file_type, _) in enumerate(work):
+      entry_inode = volume.get_inode(inode_idx, file_type)
+      reader = self.__open_read(entry_inode)
+
+      with self.__open_target(file_target) as out:
+        if not isinstance(reader, ext4.BlockReader):
+          # Inline data lives in the inode itself
+          out.write(reader.read())
+          continue
+        out.truncate(len(entry_inode))
+
+      for file_offset, disk_offset, byte_len in reader.iter_runs():
+        if disk_offset is not None:
+          runs.append((disk_offset, file_idx, file_offset, byte_len))
+
+    directory_ratio = self.__sequentiality(runs)
+    runs.sort()
+
+    image_fd = volume.stream.fileno()
+    outputs = collections.OrderedDict()
+
+    try:
+      for disk_offset, file_idx, file_offset, byte_len in runs:
+        out = outputs.pop(file_idx, None)
+        if out is None:
+          if len(outputs) >= self.MAX_OPEN_FILES:
+            outputs.popitem(last=False)[1].close()
+          out = open(work[file_idx][0], 'r+b')
+        outputs[file_idx] = out
+
+        if self.zero_copy:
+          ext4.copy_fd_range(image_fd, volume.offset + disk_offset,
+                             out.fileno(), file_offset, byte_len)
           continue
 
-        entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
-        entry_inode_path = root_path + '/' + entry_name
+        out.seek(file_offset)
+        while byte_len > 0:
+          data = volume.read(disk_offset, min(byte_len, ext4.Inode.CHUNK_SIZE))
+          if not data:
+            raise ext4.EndOfStreamError(
+              "The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len))
+          out.write(data)
+          disk_offset += len(data)
+          byte_len -= len(data)
+    finally:
+      for out in outputs.values():
+        out.close()
 
-        if entry_inode.is_dir:
-          self.num_dirs += 1
-          dir_target = self.out_dir + \
-            entry_inode_path.replace('"permissions"', 'permissions')
+    if self.manifest is not None:
+      for file_target, _, _, fingerprint in work:
+        self.__record_file(file_target, fingerprint)
 
-          if not os.path.isdir(dir_target):
-            os.makedirs(dir_target)
+    print(f'{self.__sequentiality(runs):.1%} sequential reads '
+          f'({directory_ratio:.1%} in directory order, {len(runs)} extents)')
 
-          scan_dir(entry_inode, entry_inode_path)  # loop inside the directory
+  def visit(self, entry_inode, entry_inode_idx, entry_inode_path):
+    # Create directories and symlinks right away, queue regular files for finish()
+    if entry_inode.is_dir:
+      self.num_dirs += 1
+      dir_target = self.out_dir + \
+        entry_inode_path.replace('"permissions"', 'permissions')
 
-        elif entry_inode.is_file:
-          self.num_files += 1
-          # extract files
-          raw = entry_inode.open_read().read()
+      if not os.path.isdir(dir_target) or os.path.islink(dir_target):
+        self.__remove_target(dir_target)
+        os.makedirs(dir_target)
 
-          file_target = os.path.join(self.out_dir + entry_inode_path)
+      if self.manifest is not None:
+        self.__record(dir_target, 'dir')
 
-          if os.path.isfile(file_target):
-            os.remove(file_target)
+    elif entry_inode.is_file:
+      self.num_files += 1
+      file_target = os.path.join(self.out_dir + entry_inode_path)
 
-          # write to new file
-          with open(file_target, 'wb') as out:
-            out.write(raw)
+      if entry_inode.inode.i_links_count > 1:
+        # extract the content once, link the other names to it
+        first_target = self.first_links.setdefault(entry_inode_idx, file_target)
+        if first_target != file_target:
+          self.num_hardlinks += 1
+          self.hardlinks.append((first_target, file_target))
+          return
 
-        elif entry_inode.is_symlink:
-          self.num_links += 1
-          link_target = entry_inode.open_read().read().decode("utf-8")
-          target = self.out_dir + entry_inode_path
+      fingerprint = None
+      if self.manifest is not None:
+        fingerprint = self.__fingerprint(entry_inode)
+        if self.__unchanged(file_target, fingerprint):
+          self.num_unchanged += 1
+          self.__record_file(file_target, fingerprint)
+          return
 
-          # check if file exist and remove it
-          if os.path.islink(target) or os.path.isfile(target):
-            os.remove(target)
+      self.work.append((file_target, entry_inode_idx, entry_inode.file_type, fingerprint))
 
-          # make link
-          os.symlink(link_target, target)
+    elif entry_inode.is_symlink:
+      self.num_links += 1
+      link_target = entry_inode.open_read().read().decode("utf-8")
+      target = self.out_dir + entry_inode_path
+
+      # check if file exist and remove it
+      self.__remove_target(target)
+
+      # make link
+      os.symlink(link_target, target)
+
+      if self.manifest is not None:
+        self.__record(target, 'symlink')
+
+  def finish(self, volume):
+    # Copy the content of every file queued by visit()
+    if self.order == 'physical':
+      self.__extract_physical(volume, self.work)
+    elif self.workers > 1:
+      # file data is read with pread/preadv and written without the GIL held
+      # counted here rather than in the workers
+      with ThreadPoolExecutor(self.workers) as executor:
+        for copied in executor.map(lambda entry: self.__extract_file(volume, *entry), self.work):
+          self.num_unchanged += not copied
+    else:
+      for entry in self.work:
+        self.num_unchanged += not self.__extract_file(volume, *entry)
+
+    for first_target, file_target in self.hardlinks:
+      self.__remove_target(file_target)
+      os.link(first_target, file_target)
+      if self.manifest is not None:
+        self.__record(file_target, 'hardlink')
+
+    if self.manifest is not None:
+      # a selective extraction doesn't see the rest of the tree
+      if self.include is None:
+        self.__remove_old_entries()
+      self.manifest.close(keep_removed=self.include is not None)
+      self.manifest = None
+
+    self.work = []
+    self.hardlinks = []
+
+  def extract_ext4(self):
+    if not os.path.isdir(self.out_dir):
+      os.makedirs(self.out_dir)
 
     # open image
     with open(self.image_name, 'rb') as file:
-      root = ext4.Volume(file).root
-      scan_dir(root)
+      with ext4.Volume(file, use_mmap=self.use_mmap) as volume:
+        for path, inode_idx, _, inode in self.__entries(volume):
+          self.visit(inode(), inode_idx, path)
+        self.finish(volume)
+
+    print(self.summary())
+
+  def __entries(self, volume):
+    # (path, inode_idx, file_type, inode) of the entries to extract, parents
+    # first, as Volume.walk() yields them
+    if not self.use_index:
+      yield from volume.walk(include=self.include, exclude=skip_lost_found)
+      return
+
+    # from the index (built first if stale): no directory is read
+    with Ext4Index(self.image_name, use_mmap=self.use_mmap).open() as index:
+      if self.include is None:
+        volume.load_inode_tables()
+      for entry in index.entries():
+        if entry.path == '/' or 'lost+found' in entry.path.split('/'):
+          continue
+        if self.include is not None and not self.include(entry.path, entry.type):
+          continue
+        if self.order == 'physical' and entry.type == ext4.InodeType.FILE:
+          self.extents[entry.inode] = index.extents(entry.path)
+        yield (entry.path, entry.inode, entry.type, functools.partial(volume.get_inode, entry.inode, entry.type))
+
+  def summary(self):
+    summary = f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS {self.num_hardlinks} HARDLINKS'
+    if self.num_unchanged or self.num_removed:
+      summary += f' ({self.num_unchanged} UNCHANGED {self.num_removed} REMOVED)'
+    return summary
+
 
-    print(f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS')
+def parser():
+  parser = argparse.ArgumentParser(
+    description='Extract files from ext4 image')
+  parser.add_argument('image', help='ext4 image')
+  parser.add_argument('output', help='Specify output directory')
+  parser.add_argument('-z', '--zero-copy', dest='zero_copy', action='store_true',
+                      help='Copy file data in kernel space (copy_file_range/sendfile)')
+  parser.add_argument('-j', '--jobs', dest='workers', type=int, default=1,
+                      help='Number of threads copying file data (0: one per CPU)')
+  parser.add_argument('-o', '--order', choices=['directory', 'physical'], default='directory',
+                      help='Copy file data in directory order or in one sweep over the image '
+                           'sorted by physical block (single threaded)')
+  parser.add_argument('-e', '--extract', dest='patterns', action='append', default=[],
+                      help='Extract only paths matching this glob, relative to the image root '
+                           '(e.g. build.prop, etc/selinux, app/*/*.apk); may be repeated')
+  parser.add_argument('-E', '--extract-list', dest='path_list',
+                      help='File with one path or glob per line to extract')
+  parser.add_argument('-m', '--manifest',
+                      help='Record the extraction in this file (outside the output directory) '
+                           'and only rewrite what changed since the run that wrote it')
+  parser.add_argument('-x', '--index', dest='use_index', action='store_true',
+                      help='Keep an index next to the image (<image>.index.db) and find '
+                           'the entries and extents to extract in it instead of walking the image')
+  parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                      help='Read the image with pread instead of mapping it in memory')
+  return parser
 
 
 if __name__ == '__main__':
-  if sys.argv.__len__() < 3:
-    print(f'USAGE: {sys.argv[0]} image_path out_path')
-  else:
-    print(
-      f':: Extract {ExtractExt4().file_name}.img...',
-      f':: Image path -> {ExtractExt4().image_name}',
-      f':: Info dir   -> {ExtractExt4().out_dir}',
-      sep='\n', end='\n\n')
-    ExtractExt4().extract_ext4()
+  args = parser().parse_args()
+  patterns = args.patterns
+  if args.path_list:
+    patterns += load_path_list(args.path_list)
+  extractor = ExtractExt4(args.image, args.output,
+                          zero_copy=args.zero_copy, workers=args.workers,
+                          order=args.order, patterns=patterns, manifest=args.manifest,
+                          use_mmap=args.use_mmap, use_index=args.use_index)
+  print(
+    f':: Extract {extractor.file_name}.img...',
+    f':: Image path -> {extractor.image_name}',
+    f':: Info dir   -> {extractor.out_dir}',
+    sep='\n', end='\n\n')
+  extractor.extract_ext4()
@@ -1,7 +1,22 @@
 import argparse
+import contextlib
+import io
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import ext4
+
+try:
+  import brotli
+except ImportError:  # decode with the brotli command instead
+  brotli = None
+if brotli is not None and not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+  brotli = None  # < 1.1, no output_buffer_limit: its output has no bound
 
 BLOCK_SIZE = 4096
+CHUNK_SIZE = 64 * 1024 * 1024  # largest copy handed to one worker
+STREAM_CHUNK_SIZE = 1024 * 1024  # read size of a compressed or piped new.dat
 
 
 def range_set(src):
@@ -34,7 +49,120 @@ def transfer_list_file_to_commands(trans_list):
   return commands
 
 
-def main(transfer_list_file, new_dat_file, output_filename):
+def new_ranges(commands):
+  """
+  [(offset in new.dat, offset in the image, length), ...] of every block
+  range of the new commands, new.dat holding them back to back in order
+  """
+  ranges = []
+  offset = 0
+  for command in commands:
+    if command[0] == 'new':
+      for begin, end in command[1]:
+        length = (end - begin) * BLOCK_SIZE
+        ranges.append((offset, begin * BLOCK_SIZE, length))
+        offset += length
+  return ranges
+
+
+def copy_range(src_fd, src_offset, dst_fd, dst_offset, length):
+  try:
+    ext4.copy_fd_range(src_fd, src_offset, dst_fd, dst_offset, length)
+  except ext4.EndOfStreamError:
+    raise ValueError('new.dat ends early')
+
+
+def copy_chunk(src_fd, src_offset, output_filename, dst_offset, length):
+  # A descriptor per worker: copy_fd_range seeks the output before sendfile
+  dst_fd = os.open(output_filename, os.O_WRONLY)
+  try:
+    copy_range(src_fd, src_offset, dst_fd, dst_offset, length)
+  finally:
+    os.close(dst_fd)
+
+
+class BrotliReader(io.RawIOBase):
+  """
+  Decompressed stream of a brotli file, decoded with the brotli module as
+  it is read. A few bytes of brotli can stand for hundreds of MiB, so each
+  process() call stops at STREAM_CHUNK_SIZE of output and the rest is
+  drained before more input goes in.
+  """
+
+  def __init__(self, file):
+    self.file = file
+    self.decompressor = brotli.Decompressor()
+    self.buffer = memoryview(b'')
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    while not self.buffer:
+      data = b''  # output of the last input held back by the limit
+      if self.decompressor.can_accept_more_data():
+        data = self.file.read(STREAM_CHUNK_SIZE // 16)
+        if not data:
+          if not self.decompressor.is_finished():
+            raise ValueError('Truncated brotli stream')
+          return 0
+      try:
+        self.buffer = memoryview(self.decompressor.process(data, output_buffer_limit=STREAM_CHUNK_SIZE))
+      except brotli.error as e:  # not a ValueError, unlike the other decode failures
+        raise ValueError('Corrupt brotli stream: {}'.format(e))
+
+    size = min(len(b), len(self.buffer))
+    b[:size] = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    return size
+
+
+@contextlib.contextmanager
+def open_new_dat(file_name, brotli_tool='brotli'):
+  """
+  Open a .new.dat, or a .new.dat.br decoded on the fly with the brotli
+  module (>= 1.1) or else piped from `brotli -dc`, so that the decompressed
+  new.dat never reaches the disk
+  """
+  if not file_name.endswith('.br'):
+    with open(file_name, 'rb') as file:
+      yield file
+    return
+
+  if brotli is not None:
+    with open(file_name, 'rb') as file:
+      yield io.BufferedReader(BrotliReader(file), STREAM_CHUNK_SIZE)
+    return
+
+  process = subprocess.Popen([brotli_tool, '-dc', file_name], stdout=subprocess.PIPE)
+  try:
+    yield process.stdout
+  except BaseException:
+    process.kill()
+    raise
+  finally:
+    process.stdout.close()
+    process.wait()
+  if process.returncode != 0:
+    raise ValueError('{} -dc {} failed ({})'.format(brotli_tool, file_name, process.returncode))
+
+
+def copy_stream(src, dst_fd, dst_offset, length):
+  # Sequential copy from a file object that can't seek (pipe, decoder)
+  while length > 0:
+    data = src.read(min(length, STREAM_CHUNK_SIZE))
+    if not data:
+      raise ValueError('new.dat ends {} bytes early'.format(length))
+    length -= len(data)
+    # pwrite may write less than asked, e.g. when interrupted
+    data = memoryview(data)
+    while data:
+      written = os.pwrite(dst_fd, data, dst_offset)
+      data = data[written:]
+      dst_offset += written
+
+
+def main(transfer_list_file, new_dat_file, output_filename, workers=1):
   commands = transfer_list_file_to_commands(transfer_list_file)
 
   if os.path.exists(output_filename):
@@ -45,34 +173,46 @@ def main(transfer_list_file, new_dat_file, output_filename):
   with open(output_filename, 'wb') as output_img:
     all_block_sets = [i for command in commands for i in command[1]]
     max_file_size = max(pair[1] for pair in all_block_sets) * BLOCK_SIZE
+    # full size up front, blocks no command writes stay holes
+    output_img.truncate(max_file_size)
+
+    ranges = new_ranges(commands)
+    dst_fd = output_img.fileno()
+
+    if not new_dat_file.seekable():
+      # decoded or piped: ranges come in new.dat order, one after the other
+      for _, dst_offset, length in ranges:
+        copy_stream(new_dat_file, dst_fd, dst_offset, length)
+    elif workers == 1:
+      src_fd = new_dat_file.fileno()
+      for src_offset, dst_offset, length in ranges:
+        copy_range(src_fd, src_offset, dst_fd, dst_offset, length)
+    else:
+      # split large ranges so that the workers share them evenly
+      src_fd = new_dat_file.fileno()
+      chunks = [(src_fd, src_offset + done, output_filename, dst_offset + done, min(CHUNK_SIZE, length - done))
+                for src_offset, dst_offset, length in ranges
+                for done in range(0, length, CHUNK_SIZE)]
+      with ThreadPoolExecutor(max_workers=workers or None) as executor:
+        for _ in executor.map(lambda chunk: copy_chunk(*chunk), chunks):
+          pass
 
-    for command in commands:
-      if command[0] == 'new':
-        for block in command[1]:
-          begin = block[0]
-          end = block[1]
-          block_count = end - begin
-          print('Copying {} blocks to position {}...'.format(
-            block_count, begin))
-          output_img.seek(begin * BLOCK_SIZE)
-          while block_count > 0:
-            output_img.write(new_dat_file.read(BLOCK_SIZE))
-            block_count -= 1
-      else:
-        print('Skipping command {}'.format(command[0]))
-
-    # Make file larger if necessary
-    if(output_img.tell() < max_file_size):
-      output_img.truncate(max_file_size)
+    print('Copied {} blocks in {} ranges'.format(
+      sum(length for _, _, length in ranges) // BLOCK_SIZE, len(ranges)))
 
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('transfer_list', help='transfer list file')
-  parser.add_argument('new_dat', help='system new dat file')
+  parser.add_argument('new_dat', help='system new dat file, or .new.dat.br decoded on the fly')
   parser.add_argument('output', default='output.img',
                       help='output image')
+  parser.add_argument('-j', '--jobs', dest='workers', type=int, default=1,
+                      help='Number of threads copying ranges (0: one per CPU), '
+                           'ignored for .new.dat.br')
+  parser.add_argument('--brotli', dest='brotli_tool', default='brotli',
+                      help='brotli command decoding .new.dat.br without the brotli module (>= 1.1)')
   args = parser.parse_args()
   with open(args.transfer_list, 'r') as transfer_list_file:
-    with open(args.new_dat, 'rb') as new_dat_file:
-      main(transfer_list_file, new_dat_file, args.output)
+    with open_new_dat(args.new_dat, args.brotli_tool) as new_dat_file:
+      main(transfer_list_file, new_dat_file, args.output, workers=args.workers)
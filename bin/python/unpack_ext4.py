@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+
+import ext4
+from ext4_info import ReadExt4, skip_lost_found
+from extract_ext4 import ExtractExt4
+
+
+class UnpackExt4():
+  """
+  Save information (file_config, file_contexts, file_features) and extract
+  files of an ext4 image with one walk over its directory tree
+  """
+
+  def __init__(self, image_name, info_dir, out_dir, zero_copy=False, workers=1, order='directory',
+               manifest=None, use_mmap=True):
+    self.reader = ReadExt4(image_name, info_dir, use_mmap=use_mmap)
+    self.extractor = ExtractExt4(image_name, out_dir, zero_copy=zero_copy,
+                                 workers=workers, order=order, manifest=manifest,
+                                 use_mmap=use_mmap)
+    # one Volume serves both, read as the extractor needs it
+    self.use_mmap = self.extractor.use_mmap
+    self.image_name = self.reader.image_name
+    self.file_name = self.reader.file_name
+
+  def unpack_ext4(self):
+    if not os.path.isdir(self.extractor.out_dir):
+      os.makedirs(self.extractor.out_dir)
+
+    # open image
+    with open(self.image_name, 'rb') as file:
+      with ext4.Volume(file, use_mmap=self.use_mmap) as volume:
+        for path, inode_idx, _, inode in volume.walk(exclude=skip_lost_found):
+          entry_inode = inode()
+          self.reader.visit(entry_inode, path)
+          self.extractor.visit(entry_inode, inode_idx, path)
+        self.extractor.finish(volume)
+
+    self.reader.finish()
+    print(self.extractor.summary())
+
+
+def parser():
+  parser = argparse.ArgumentParser(
+    description='Save information and extract files from ext4 image in one pass')
+  parser.add_argument('image', help='ext4 image')
+  parser.add_argument('info', help='Specify information directory')
+  parser.add_argument('output', help='Specify output directory')
+  parser.add_argument('-z', '--zero-copy', dest='zero_copy', action='store_true',
+                      help='Copy file data in kernel space (copy_file_range/sendfile)')
+  parser.add_argument('-j', '--jobs', dest='workers', type=int, default=1,
+                      help='Number of threads copying file data (0: one per CPU)')
+  parser.add_argument('-o', '--order', choices=['directory', 'physical'], default='directory',
+                      help='Copy file data in directory order or in one sweep over the image '
+                           'sorted by physical block (single threaded)')
+  parser.add_argument('-m', '--manifest',
+                      help='Record the extraction in this file (outside the output directory) '
+                           'and only rewrite what changed since the run that wrote it')
+  parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                      help='Read the image with pread instead of mapping it in memory')
+  return parser
+
+
+if __name__ == '__main__':
+  args = parser().parse_args()
+  unpacker = UnpackExt4(args.image, args.info, args.output, zero_copy=args.zero_copy,
+                        workers=args.workers, order=args.order, manifest=args.manifest,
+                        use_mmap=args.use_mmap)
+  print(
+    f':: Unpack {unpacker.file_name}.img...',
+    f':: Image path -> {unpacker.image_name}',
+    f':: Info dir   -> {unpacker.reader.out_dir}',
+    f':: Output dir -> {unpacker.extractor.out_dir}',
+    sep='\n', end='\n\n')
+  unpacker.unpack_ext4()
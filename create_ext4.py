@@ -3,7 +3,9 @@
 
 
 import os
+import posixpath
 import shutil
+import stat
 import subprocess
 import sys
 import time
@@ -25,6 +27,10 @@ config_dir = os.path.join(load_config('MAIN', 'main_project'), 'config')
 build_dir = os.path.join(load_config('MAIN', 'main_project'), 'build')
 out_dir = os.path.join(load_config('MAIN', 'main_project'), 'output')
 
+sys.path.insert(0, os.path.dirname(load_config('PYTHON', 'ext4_info')))
+from compact_config import (  # noqa: E402
+  compact_file_contexts, compact_fs_config, expand_fs_config, read_lines)
+
 
 def dump_data(file):
   """
@@ -103,6 +109,86 @@ def run_command(cmd, env):
   return output, p.returncode
 
 
+def output_modes(part, mount_point):
+  """paths of the output directory of part as e2fsdroid looks them up:
+  mount point + path in the image
+
+  Returns:
+      path -> st_mode: dict
+  """
+  part_dir = os.path.join(out_dir, part)
+  modes = {mount_point: stat.S_IFDIR}
+  for root, dirs, files in os.walk(part_dir):
+    for name in dirs + files:
+      path = os.path.join(root, name)
+      rel_path = os.path.relpath(path, part_dir).replace(os.sep, '/')
+      modes[posixpath.join(mount_point, rel_path)] = os.lstat(path).st_mode
+
+  return modes
+
+
+def canned_fs_config(part, mount_point):
+  """fold <part>_file_config.txt into subtree rules of each file type and
+  expand them back over every file of the output directory, so that files
+  added since the extraction get the config of the entries of their type
+  around them instead of failing the canned fs_config lookup of e2fsdroid
+
+  Returns:
+      -C argument of e2fsdroid: str
+  """
+  config = os.path.join(config_dir, part+'_file_config.txt')
+  canned_file = os.path.join(build_dir, part+'_file_config.txt')
+
+  try:
+    lines = read_lines(config)
+    # a new directory must not get the mode of the files around it
+    modes = output_modes(part, mount_point)
+    modes.setdefault('/', stat.S_IFDIR)
+    canned = expand_fs_config(compact_fs_config(lines, modes), modes)
+  except (OSError, ValueError) as e:
+    logger.warning(f"Keep {config}: {e}")
+    return config
+
+  with open(canned_file, 'w') as file:
+    for line in canned:
+      file.write(line + '\n')
+  logger.info(f"Expand {config}: {len(lines)} -> {len(canned)} paths")
+
+  return canned_file
+
+
+def compact_contexts(part, mount_point):
+  """fold <part>_file_contexts.txt into subtree rules, checked against every
+  file of the output directory, so that e2fsdroid matches a few regexes
+  instead of one line per file
+
+  Returns:
+      -S arguments of e2fsdroid: list
+  """
+  contexts = os.path.join(config_dir, part+'_file_contexts.txt')
+  plat_contexts = os.path.join(config_dir, 'file_contexts.txt')
+  compact_file = os.path.join(build_dir, part+'_file_contexts.txt')
+
+  modes = output_modes(part, mount_point)
+  modes[posixpath.join(mount_point, 'lost+found')] = stat.S_IFDIR
+
+  try:
+    extra_lines = read_lines(plat_contexts) if os.path.isfile(plat_contexts) else []
+    lines = read_lines(contexts)
+    compacted = compact_file_contexts(lines, modes, extra_lines)
+  except (OSError, ValueError) as e:
+    logger.warning(f"Keep {contexts}: {e}")
+    return ['-S', contexts, '-S', plat_contexts]
+
+  with open(compact_file, 'w') as file:
+    for line in compacted:
+      file.write(line + '\n')
+  logger.info(f"Compact {contexts}: {len(lines)} -> {len(compacted)} rules")
+
+  # read last: its subtree rules win over the regexes of plat_file_contexts
+  return ['-S', plat_contexts, '-S', compact_file]
+
+
 def make_ext4(raw=False, sparse=False, brotli=False):
   images_build = print_images()
 
@@ -146,23 +232,23 @@ def make_ext4(raw=False, sparse=False, brotli=False):
 
         if part == 'system':
           e2fsdroid_cmd = [
-            e2fsdroid, '-e', '-T', '1230768000', '-C', os.path.join(config_dir, part+'_file_config.txt'), '-S', os.path.join(
-              config_dir, part+'_file_contexts.txt'), '-S', os.path.join(config_dir, 'file_contexts.txt'), '-f', os.path.join(out_dir, part), '-a', '/', os.path.join(build_dir, part+'.img')
+            e2fsdroid, '-e', '-T', '1230768000', '-C', canned_fs_config(part, '/'), *compact_contexts(part, '/'),
+            '-f', os.path.join(out_dir, part), '-a', '/', os.path.join(build_dir, part+'.img')
           ]
 
         else:
           try:
             e2fsdroid_cmd = [
-              e2fsdroid, '-e', '-T', '1230768000', '-C', os.path.join(config_dir, part+'_file_config.txt'), '-S', os.path.join(
-                config_dir, part+'_file_contexts.txt'), '-S', os.path.join(config_dir, 'file_contexts.txt'), '-f', os.path.join(out_dir, part), '-a', '/'+part, os.path.join(build_dir, part+'.img')
+              e2fsdroid, '-e', '-T', '1230768000', '-C', canned_fs_config(part, '/'+part), *compact_contexts(part, '/'+part),
+              '-f', os.path.join(out_dir, part), '-a', '/'+part, os.path.join(build_dir, part+'.img')
             ]
 
           except:
             logger.info(
               f"Try without ({os.path.join(config_dir, part+'_file_config.txt')})")
             e2fsdroid_cmd = [
-              e2fsdroid, '-e', '-T', '1230768000', '-S', os.path.join(
-                config_dir, part+'_file_contexts.txt'), '-S', os.path.join(config_dir, 'file_contexts.txt'), '-f', os.path.join(out_dir, part), '-a', '/'+part, os.path.join(build_dir, part+'.img')
+              e2fsdroid, '-e', '-T', '1230768000', *compact_contexts(part, '/'+part),
+              '-f', os.path.join(out_dir, part), '-a', '/'+part, os.path.join(build_dir, part+'.img')
             ]
 
         output, ret = run_command(e2fsdroid_cmd, e2fsdroid_env)
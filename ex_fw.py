@@ -18,6 +18,10 @@ lpunpack = load_config('LINUX', 'lpunpack')
 payload = load_config('LINUX', 'payload')
 sdat2img = load_config('PYTHON', 'sdat2img')
 
+# sdat2img is imported from bin/python and run in-process
+sys.path.insert(0, os.path.dirname(sdat2img))
+from sdat2img import main as sdat2img_main, open_new_dat  # noqa: E402
+
 #########################
 
 
@@ -122,27 +126,23 @@ def extract_brotli(br_img, output):
   if os.path.exists(br_img):
     basedir = os.path.realpath(os.path.dirname(br_img))
     output = os.path.realpath(output)
-    sdat_img = br_img.split('.br')[0]
     img_name = os.path.basename(br_img).split('.')[0]
     # check if output folder exists (if not make it)
     if not os.path.exists(output):
       mkdir(output)
 
-    logger.info("Convert %s.new.dat.br to %s.new.dat" % (img_name, img_name))
-    cmd = [brotli, '-df', br_img]
-    RunCommand(cmd, verbose=True)
-
-    if os.path.exists(sdat_img):
-      logger.info('Convertig %s.new.dat to %s.img' % (img_name, img_name))
-      cmd = [
-        'python', sdat2img, os.path.join(
-          basedir, img_name+'.transfer.list'), sdat_img, os.path.join(output, img_name+'.img')
-      ]
-      RunCommand(cmd, verbose=True)
+    # decode the .br while writing the image, new.dat never reaches the disk
+    logger.info('Convertig %s.new.dat.br to %s.img' % (img_name, img_name))
+    try:
+      with open(os.path.join(basedir, img_name+'.transfer.list'), 'r') as transfer_list_file, \
+          open_new_dat(br_img, brotli) as new_dat_file:
+        sdat2img_main(transfer_list_file, new_dat_file, os.path.join(output, img_name+'.img'))
+    except (OSError, ValueError) as e:
+      logger.error("Failed to convert %s: %s" % (br_img, e))
+      remove(os.path.join(output, img_name+'.img'))
 
     if os.path.exists(os.path.join(output, img_name+'.img')):
       remove(br_img)
-      remove(os.path.join(output, img_name+'.new.dat'))
       remove(os.path.join(output, img_name+'.transfer.list'))
 
   else:
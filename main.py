@@ -11,12 +11,17 @@ from loguru import logger
 import create_ext4
 import ex_fw
 from config import load_config, update_config
-from utils import RunCommand, init_log, mkdir, rmdir
+from utils import init_log, mkdir, rmdir
 
 __version__ = '1.0'
 
 PARTITIONS = load_config('MAIN', 'partitions').split(' ')
 
+# ext4 tools are imported from bin/python and run in-process
+sys.path.insert(0, os.path.dirname(load_config('PYTHON', 'ext4_info')))
+from extract_ext4 import ExtractExt4, load_path_list  # noqa: E402
+from unpack_ext4 import UnpackExt4  # noqa: E402
+
 
 def init_folders(project):
   folders = load_config('MAIN', 'proj_folders').split(' ')
@@ -29,6 +34,14 @@ def parser():
     description='')
   parser.add_argument('-n', dest='name', help='Specify project name')
   parser.add_argument('-i', dest='input', help='Input zip')
+  parser.add_argument('-e', dest='patterns', action='append', default=[],
+                      help='Extract only paths matching this glob from each partition '
+                           '(e.g. build.prop, etc/selinux) with [-i]; may be repeated')
+  parser.add_argument('-E', dest='path_list',
+                      help='File with one path or glob per line to extract with [-i]')
+  parser.add_argument('-u', dest='update', action='store_true',
+                      help='Keep the existing project and only rewrite the files '
+                           'that changed since its last extraction, with [-i]')
   parser.add_argument('-l', dest='lst', action='store_true',
                       help='List of projects')
   parser.add_argument('-R', dest='raw', action='store_true',
@@ -70,7 +83,7 @@ if __name__ == '__main__':
       print('\t%s' % p)
 
   if args.input:
-    if os.path.isdir(os.path.join('projects', args.name)):
+    if not args.update and os.path.isdir(os.path.join('projects', args.name)):
       logger.warning("This project exist")
       choice = input("If you want to continu will delete this project [y/n]: ")
       if choice.lower() == 'y':
@@ -79,22 +92,26 @@ if __name__ == '__main__':
       else:
         pass
 
+    patterns = args.patterns
+    if args.path_list:
+      patterns += load_path_list(args.path_list)
+
     ex_fw.main(args.input, os.path.join(main_project, 'source'), 'Log.txt')
     for part in PARTITIONS:
-      ext4_info = os.path.join(load_config('PYTHON', 'ext4_info'))
-      extract_ext4 = os.path.join(load_config('PYTHON', 'extract_ext4'))
-
       input_img = os.path.join(main_project, 'source', part+'.img')
       info_dir = os.path.join(main_project, 'config')
       out_dir = os.path.join(main_project, 'output', part)
+      # extraction record used by [-u], kept outside the output tree
+      manifest = os.path.join(info_dir, part + '_manifest.jsonl')
       if os.path.isfile(input_img):
         mkdir(out_dir)
-        logger.info("Extract information {}", part)
-        cmd = ['python', ext4_info, input_img, info_dir]
-        RunCommand(cmd, verbose=True)
-        logger.info("Extract {} to {}", input_img, out_dir)
-        cmd = ['python', extract_ext4, input_img, out_dir]
-        RunCommand(cmd, verbose=True)
+        if patterns:
+          # partial tree: extract the matches only, without information
+          logger.info("Extract {} from {} to {}", ' '.join(patterns), input_img, out_dir)
+          ExtractExt4(input_img, out_dir, patterns=patterns, manifest=manifest).extract_ext4()
+        else:
+          logger.info("Unpack {} to {}", input_img, out_dir)
+          UnpackExt4(input_img, info_dir, out_dir, manifest=manifest).unpack_ext4()
 
   if args.raw:
     raw = True
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the ext4 tools are scripts in bin/python, imported the way main.py does
+sys.path.insert(0, os.path.join(ROOT, 'bin', 'python'))
+
+
+def make_tree(src):
+  # A small tree with the kinds of entries the tools handle
+  os.makedirs(os.path.join(src, 'app', 'Foo'))
+  os.makedirs(os.path.join(src, 'etc', 'selinux'))
+  os.makedirs(os.path.join(src, 'empty'))
+  with open(os.path.join(src, 'build.prop'), 'w') as file:
+    file.write('ro.build.id=TEST\n')
+  with open(os.path.join(src, 'app', 'Foo', 'Foo.apk'), 'wb') as file:
+    file.write(os.urandom(300000))
+  with open(os.path.join(src, 'etc', 'selinux', 'plat_file_contexts'), 'w') as file:
+    file.write('/system(/.*)? u:object_r:system_file:s0\n')
+  with open(os.path.join(src, 'a+b.txt'), 'w') as file:
+    file.write('plus\n')
+  with open(os.path.join(src, 'sparse.bin'), 'wb') as file:
+    file.seek(1 << 20)
+    file.write(b'end')
+  with open(os.path.join(src, 'fragmented.bin'), 'wb') as file:
+    # more extents than fit in the inode: an extent tree of depth 1
+    for block in range(0, 16, 2):
+      file.seek(block * 4096)
+      file.write(os.urandom(4096))
+  open(os.path.join(src, 'zero.bin'), 'w').close()
+  os.symlink('/system/build.prop', os.path.join(src, 'etc', 'prop'))
+  os.symlink('../build.prop', os.path.join(src, 'etc', 'default.prop'))
+  os.link(os.path.join(src, 'build.prop'), os.path.join(src, 'etc', 'build.prop'))
+
+
+@pytest.fixture
+def image(tmp_path):
+  """
+  path of an ext4 image (sys.img) made by mke2fs from make_tree(), its
+  source tree is tmp_path/src
+  """
+  mke2fs = shutil.which('mke2fs') or shutil.which('mkfs.ext4')
+  if mke2fs is None:
+    pytest.skip('mke2fs is needed to make test images')
+
+  src = tmp_path / 'src'
+  make_tree(str(src))
+  image = tmp_path / 'sys.img'
+  subprocess.run([mke2fs, '-q', '-F', '-t', 'ext4', '-b', '4096', '-d', str(src), str(image), '16M'],
+                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return str(image)
+
+
+def tree(root):
+  # {relative path: (kind, content)} of a directory tree, to compare two
+  result = {}
+  for dir_path, dir_names, file_names in os.walk(root):
+    for name in dir_names + file_names:
+      path = os.path.join(dir_path, name)
+      rel_path = os.path.relpath(path, root)
+      if os.path.islink(path):
+        result[rel_path] = ('link', os.readlink(path))
+      elif os.path.isdir(path):
+        result[rel_path] = ('dir', None)
+      else:
+        with open(path, 'rb') as file:
+          result[rel_path] = ('file', file.read())
+  return result
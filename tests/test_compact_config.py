@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import stat
+
+from compact_config import LabelRules, compact_file_contexts, compact_fs_config, expand_fs_config
+
+FS_CONFIG = [
+  '/ 0 0 0755',
+  'system 0 0 0755',
+  'app 0 0 0755',
+  'app/Foo 0 0 0755',
+  'app/Foo/Foo.apk 0 0 0644',
+  'bin 0 2000 0751',
+  'bin/sh 0 2000 0755',
+  'bin/toybox 0 2000 0755',
+  'bin/run-as 0 2000 0750 capabilities=0xc0',
+  'build.prop 0 0 0600',
+  'etc 0 0 0755',
+  'etc/hosts 0 0 0644',
+  'etc/init 0 0 0755',
+  'etc/init/a.rc 0 0 0644',
+]
+
+
+def test_fs_config_round_trip():
+  compacted = compact_fs_config(FS_CONFIG)
+  assert len(compacted) < len(FS_CONFIG)
+
+  modes = dict.fromkeys(LabelRules.from_fs_config(FS_CONFIG).paths(), 0)
+  assert sorted(expand_fs_config(compacted, modes)) == sorted(FS_CONFIG)
+
+
+def test_fs_config_expands_to_new_files():
+  # bin is mostly 0755 files: a subtree rule gives them that
+  expanded = expand_fs_config(compact_fs_config(FS_CONFIG), {'/bin/ls': 0, '/etc/init/b.rc': 0})
+  assert expanded[0] == 'bin/ls 0 2000 0755'
+  assert [line.split(' ', 1)[0] for line in expanded] == ['bin/ls', 'etc/init/b.rc']
+
+
+def test_fs_config_by_file_type():
+  modes = {'/' + line.split(' ', 1)[0].lstrip('/'): stat.S_IFREG for line in FS_CONFIG}
+  for path in ('/', '/system', '/app', '/app/Foo', '/bin', '/etc', '/etc/init'):
+    modes[path] = stat.S_IFDIR
+  # added since the extraction
+  new = {'/etc/init/sub': stat.S_IFDIR, '/etc/new.conf': stat.S_IFREG,
+         '/app/Bar': stat.S_IFDIR, '/bin/ls': stat.S_IFREG, '/bin/sh.d': stat.S_IFLNK}
+
+  compacted = compact_fs_config(FS_CONFIG, dict(modes, **new))
+  assert compacted == [line for line in compacted if line.split()[1] in ('--', '-d')]
+  expanded = expand_fs_config(compacted, dict(modes, **new))
+  assert sorted(set(expanded) - set(FS_CONFIG)) == [
+    'app/Bar 0 0 0755',
+    'bin/ls 0 2000 0755',
+    'etc/init/sub 0 0 0755',
+    'etc/new.conf 0 0 0644',
+  ]
+  # the configured paths keep their line, a symlink has none to follow and is
+  # left out for e2fsdroid to report
+  assert set(FS_CONFIG) <= set(expanded)
+  assert not [line for line in expanded if line.startswith('bin/sh.d ')]
+
+
+def test_file_contexts_keep_their_labels():
+  lines = [
+    '/system(/.*)? u:object_r:system_file:s0',
+    '/system/bin/sh u:object_r:shell_exec:s0',
+    '/system/bin/toybox u:object_r:toolbox_exec:s0',
+    '/system/bin/ls u:object_r:toolbox_exec:s0',
+    '/system/bin/ps u:object_r:toolbox_exec:s0',
+  ]
+  plat = ['/system/bin(/.*)? u:object_r:system_file:s0',
+          '/system/bin/.*\\.sh u:object_r:script_exec:s0']
+  modes = {'/system': stat.S_IFDIR, '/system/bin': stat.S_IFDIR, '/system/bin/sh': stat.S_IFREG,
+           '/system/bin/toybox': stat.S_IFREG, '/system/bin/ls': stat.S_IFREG,
+           '/system/bin/ps': stat.S_IFREG, '/system/bin/x.sh': stat.S_IFREG}
+
+  compacted = compact_file_contexts(lines, modes, plat)
+  original = LabelRules.from_file_contexts(lines + plat)
+  rules = LabelRules.from_file_contexts(plat + compacted)
+  for path, mode in modes.items():
+    assert rules.lookup(path, mode) == original.lookup(path, mode)
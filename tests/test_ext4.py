@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import errno
+import mmap
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import ext4
+
+from conftest import tree
+
+
+def listing(volume):
+  return sorted((path, inode().inode.i_mode) for path, _, _, inode in volume.walk())
+
+
+def test_mmap_falls_back_to_pread(image, monkeypatch):
+  with open(image, 'rb') as file:
+    expected = listing(ext4.Volume(file))
+
+  def fail(*args, **kwargs):
+    raise OSError(errno.ENOMEM, 'Cannot allocate memory')
+
+  monkeypatch.setattr(mmap, 'mmap', fail)
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file, use_mmap=True)
+    assert volume.mmap is None
+    assert listing(volume) == expected
+
+
+def test_mmap_and_pread_read_the_same(image):
+  with open(image, 'rb') as file:
+    mapped = ext4.Volume(file, use_mmap=True)
+    assert mapped.mmap is not None
+    plain = ext4.Volume(file, use_mmap=False)
+    assert listing(mapped) == listing(plain)
+    assert mapped.root.get_inode('build.prop').open_read().read() == \
+      plain.root.get_inode('build.prop').open_read().read()
+
+
+def test_walk_uses_loaded_inode_tables(image, monkeypatch):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+
+    reads = []
+    read = volume.read
+    monkeypatch.setattr(volume, 'read', lambda offset, byte_len: reads.append(offset) or read(offset, byte_len))
+
+    inode_size = volume.superblock.s_inode_size
+    for path, inode_idx, _, inode in volume.walk():
+      group_idx, entry_idx = volume.get_inode_group(inode_idx)
+      offset = volume.group_descriptors[group_idx].bg_inode_table * volume.block_size + entry_idx * inode_size
+      assert bytes(inode().raw[:inode_size]) == bytes(read(offset, inode_size))
+      # neither the inode nor the extent header in its i_block is read again
+      inode().open_read()
+      assert offset not in reads and offset + ext4.ext4_inode.i_block.offset not in reads, path
+    assert volume.inode_tables
+
+
+def test_extent_tree(image, tmp_path):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    entry_inode = volume.root.get_inode('fragmented.bin')
+    assert ext4.ext4_extent_header.from_buffer_copy(entry_inode.raw, ext4.ext4_inode.i_block.offset).eh_depth == 1
+    assert entry_inode.open_read().read() == (tmp_path / 'src' / 'fragmented.bin').read_bytes()
+
+
+def test_selective_walk_leaves_inode_tables(image):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    assert [path for path, _, _, _ in volume.walk(include=lambda path, _: path == '/build.prop')] == \
+      ['/build.prop']
+    assert not volume.inode_tables
+
+
+def test_inode_table_rows(image):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    volume.load_inode_tables()
+    rows = {row[0]: row for table in volume.inode_tables.values() for row in table.rows()}
+
+    for path, inode_idx, _, inode in volume.walk():
+      raw = inode().inode
+      assert rows[inode_idx] == (inode_idx, raw.i_mode, raw.i_uid, raw.i_gid, raw.i_size,
+                                 raw.i_links_count, raw.i_flags, raw.i_file_acl), path
+
+
+def test_close_releases_mmap(image):
+  with open(image, 'rb') as file:
+    with ext4.Volume(file, use_mmap=True) as volume:
+      mapping = volume.mmap
+      volume.load_inode_tables()
+      assert listing(volume)
+    assert volume.mmap is None and volume.view is None
+    with pytest.raises(ValueError):
+      mapping[0]  # unmapped
+    assert not file.closed  # the stream is the caller's
+
+
+def copy(tmp_path, data, src_offset, dst_offset, byte_len):
+  # copy_fd_range between two files, returns the destination content
+  src = tmp_path / 'src.bin'
+  src.write_bytes(data)
+  dst = tmp_path / 'dst.bin'
+  dst.write_bytes(b'')
+  src_fd = os.open(src, os.O_RDONLY)
+  dst_fd = os.open(dst, os.O_WRONLY)
+  try:
+    ext4.copy_fd_range(src_fd, src_offset, dst_fd, dst_offset, byte_len)
+  finally:
+    os.close(src_fd)
+    os.close(dst_fd)
+  return dst.read_bytes()
+
+
+@pytest.mark.parametrize('primitives', ['copy_file_range', 'sendfile', 'pread'])
+def test_copy_fd_range(tmp_path, monkeypatch, primitives):
+  if primitives != 'copy_file_range':
+    monkeypatch.setattr(ext4, '_copy_file_range', None)
+  if primitives == 'pread':
+    monkeypatch.setattr(ext4, '_sendfile', None)
+  data = os.urandom(3 << 20)
+  assert copy(tmp_path, data, 4096, 100, len(data) - 8192) == bytes(100) + data[4096:-4096]
+
+  with pytest.raises(ext4.EndOfStreamError):
+    copy(tmp_path, data, 4096, 0, len(data))
+
+
+def test_copy_fd_range_falls_back_when_unsupported(tmp_path, monkeypatch):
+  def unsupported(*args):
+    raise OSError(errno.ENOSYS, 'Function not implemented')
+
+  monkeypatch.setattr(ext4, '_copy_file_range', unsupported)
+  data = os.urandom(10000)
+  assert copy(tmp_path, data, 0, 0, len(data)) == data
+  assert ext4._copy_file_range is None  # not tried again
+
+
+def test_copy_fd_range_raises_call_errors(tmp_path, monkeypatch):
+  def bad_fd(*args):
+    raise OSError(errno.EBADF, 'Bad file descriptor')
+
+  monkeypatch.setattr(ext4, '_copy_file_range', bad_fd)
+  with pytest.raises(OSError):
+    copy(tmp_path, b'data', 0, 0, 4)
+  assert ext4._copy_file_range is bad_fd  # still used by later copies
+
+
+@pytest.fixture
+def unwritten_image(image):
+  """
+  image with /build.prop grown to 8 blocks: its data block, a hole, 4
+  unwritten blocks over non-zero disk content and a trailing hole
+  """
+  debugfs = shutil.which('debugfs')
+  if debugfs is None:
+    pytest.skip('debugfs is needed to make unwritten extents')
+
+  def run(request):
+    return subprocess.run([debugfs, '-w', '-R', request, image], check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+
+  run('fallocate /build.prop 2 5')
+  run('sif /build.prop size 32768')
+  block = int(run('bmap /build.prop 2').split()[0])
+  with open(image, 'r+b') as file:
+    file.seek(block * 4096)
+    file.write(b'\xaa' * 4 * 4096)
+  return image
+
+
+def test_holes_and_unwritten_extents(unwritten_image):
+  expected = b'ro.build.id=TEST\n'.ljust(32768, b'\0')
+  with open(unwritten_image, 'rb') as file:
+    entry_inode = ext4.Volume(file).root.get_inode('build.prop')
+    reader = entry_inode.open_read()
+    assert [(offset, disk is not None, length) for offset, disk, length in reader.iter_runs()] == \
+      [(0, True, 4096), (4096, False, 28672)]
+    assert reader.read() == expected
+
+    # reads crossing from data into the holes
+    reader.seek(4000)
+    buffer = bytearray(10000)
+    assert reader.readinto(buffer) == 10000
+    assert bytes(buffer) == expected[4000:14000]
+
+
+def test_copy_to_keeps_holes(unwritten_image, tmp_path):
+  expected = b'ro.build.id=TEST\n'.ljust(32768, b'\0')
+  with open(unwritten_image, 'rb') as file:
+    entry_inode = ext4.Volume(file).root.get_inode('build.prop')
+
+    with open(tmp_path / 'sparse', 'wb') as out:
+      assert entry_inode.copy_to(out, size=4096) == len(expected)
+    assert (tmp_path / 'sparse').read_bytes() == expected
+    assert os.stat(tmp_path / 'sparse').st_blocks * 512 <= 4096
+
+    # an output that can't seek gets the holes as zeros
+    read_fd, write_fd = os.pipe()
+    with open(write_fd, 'wb', buffering=0) as out:
+      with open(read_fd, 'rb') as pipe:
+        entry_inode.copy_to(out, size=4096)
+        out.close()
+        assert pipe.read() == expected
+
+
+def test_lru_cache():
+  cache = ext4.LRUCache(2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  assert cache.get('a') == 1  # 'b' is now the least recently used
+  cache.put('c', 3)
+  assert 'b' not in cache and len(cache) == 2
+  assert cache.get('b') is None and cache.get('c') == 3
+  assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_volume_caches(image):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    caches = volume.cache_info()
+
+    inode = volume.root.get_inode('app', 'Foo', 'Foo.apk')
+    assert volume.root.get_inode('app', 'Foo', 'Foo.apk') is inode
+    assert caches['inode'].hits >= 3
+
+    # the lookup of 'app' indexed the whole root directory: its siblings
+    # are hits, and so is a missing name once looked up
+    misses = caches['dentry'].misses
+    volume.root.get_inode('build.prop')
+    volume.root.get_inode('a+b.txt')
+    assert caches['dentry'].misses == misses
+    for _ in range(2):
+      with pytest.raises(FileNotFoundError):
+        volume.root.get_inode('missing')
+    assert caches['dentry'].misses == misses + 1
+
+
+@pytest.mark.parametrize('hash_alg', ['half_md4', 'tea', 'legacy'])
+def test_htree_lookup(tmp_path, monkeypatch, hash_alg):
+  tools = [shutil.which(tool) for tool in ('mke2fs', 'tune2fs', 'e2fsck')]
+  if None in tools:
+    pytest.skip('mke2fs, tune2fs and e2fsck are needed to make indexed directories')
+  mke2fs, tune2fs, e2fsck = tools
+
+  names = ['file_{0:d}.txt'.format(i) for i in range(600)]
+  os.makedirs(tmp_path / 'src' / 'big')
+  for name in names:
+    (tmp_path / 'src' / 'big' / name).touch()
+  image = str(tmp_path / 'htree.img')
+  subprocess.run([mke2fs, '-q', '-F', '-t', 'ext4', '-b', '4096', '-d', str(tmp_path / 'src'), image, '16M'],
+                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  subprocess.run([tune2fs, '-E', 'hash_alg=' + hash_alg, image],
+                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  # mke2fs -d writes linear directories, e2fsck -D indexes them
+  subprocess.run([e2fsck, '-fyD', image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    big = volume.root.get_inode('big')
+    assert big.inode.i_flags & ext4.ext4_inode.EXT4_INDEX_FL
+    entries = {name: (inode_idx, file_type) for name, inode_idx, file_type in big.open_dir()}
+
+    # named lookups go through the hash tree, never through a full scan
+    monkeypatch.setattr(ext4.Inode, 'open_dir', lambda *args: pytest.fail('linear scan'))
+    for name in names:
+      assert big.dx_lookup(name.encode()) == entries[name]
+      assert volume.lookup(big, name) == entries[name]
+    assert big.dx_lookup(b'missing.txt') == (None, None)
+
+
+def test_xattrs_are_shared(image, tmp_path, monkeypatch):
+  debugfs = shutil.which('debugfs')
+  if debugfs is None:
+    pytest.skip('debugfs is needed to set xattrs')
+
+  big = os.urandom(1500).hex().encode()  # too large for the inode: goes to an xattr block
+  (tmp_path / 'big').write_bytes(big)
+  requests = ['ea_set {0:s} security.selinux u:object_r:system_file:s0'.format(path)
+              for path in ('/build.prop', '/a+b.txt', '/app')]
+  requests.append('ea_set -f {0:s} /zero.bin user.big'.format(str(tmp_path / 'big')))
+  for request in requests:
+    subprocess.run([debugfs, '-w', '-R', request, image], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    contexts = [dict(volume.root.get_inode(name).xattrs())['security.selinux']
+                for name in ('build.prop', 'a+b.txt', 'app')]
+    assert contexts[0] == b'u:object_r:system_file:s0'
+    assert contexts[1] is contexts[0] and contexts[2] is contexts[0]
+
+    zero = volume.root.get_inode('zero.bin')
+    assert dict(zero.xattrs())['user.big'] == big
+
+    # the block is parsed once, later reads come from the cache
+    monkeypatch.setattr(volume, 'read', lambda offset, byte_len: pytest.fail('xattr block read again'))
+    assert dict(zero.xattrs())['user.big'] == big
+    assert volume.xattr_block_cache.hits == 1
+
+
+def test_walk_paths(image, tmp_path):
+  src = str(tmp_path / 'src')
+  expected = {'/' + path for path in tree(src)} | {'/lost+found'}
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    depth_first = [path for path, _, _, _ in volume.walk()]
+    breadth_first = [path for path, _, _, _ in volume.walk(breadth_first=True)]
+
+  assert set(depth_first) == set(breadth_first) == expected
+  assert len(depth_first) == len(expected)
+  # a directory's children right after it, or after all of its siblings
+  assert depth_first.index('/app/Foo') == depth_first.index('/app') + 1
+  assert max(breadth_first.index(path) for path in expected if path.count('/') == 1) < \
+    breadth_first.index('/app/Foo')
+
+
+def test_walk_include_exclude(image, monkeypatch):
+  with open(image, 'rb') as file:
+    volume = ext4.Volume(file)
+    opened = []
+    open_dir = ext4.Inode.open_dir
+    monkeypatch.setattr(ext4.Inode, 'open_dir',
+                        lambda inode, *args: opened.append(inode.inode_idx) or open_dir(inode, *args))
+
+    excluded = [path for path, _, _, _ in volume.walk(exclude=lambda path, _: path == '/etc')]
+    assert '/etc' not in excluded and not any(path.startswith('/etc/') for path in excluded)
+    etc_idx, _ = volume.lookup(volume.root, 'etc')
+    assert etc_idx not in opened  # pruned subtrees are never read
+
+    included = [(path, file_type) for path, _, file_type, _ in volume.walk(
+      include=lambda path, file_type: file_type == ext4.InodeType.DIRECTORY or path.endswith('.apk'))]
+    assert [path for path, file_type in included if file_type != ext4.InodeType.DIRECTORY] == \
+      ['/app/Foo/Foo.apk']
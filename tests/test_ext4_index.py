@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+from ext4_index import Ext4Index
+
+
+def test_hashes_requested_rebuild_index(image, tmp_path):
+  with Ext4Index(image).open() as index:
+    assert index.stat('/build.prop').sha256 is None
+  built = os.stat(image + Ext4Index.SUFFIX).st_mtime_ns
+
+  with Ext4Index(image) as index:
+    assert index.is_valid()
+    assert not index.is_valid(hash_content=True)
+    index.open(hash_content=True)
+    with open(tmp_path / 'src' / 'build.prop', 'rb') as file:
+      assert index.stat('/build.prop').sha256 == hashlib.sha256(file.read()).hexdigest()
+
+  # an index with hashes also serves readers that don't need them
+  with Ext4Index(image) as index:
+    assert index.is_valid() and index.is_valid(hash_content=True)
+    index.open()
+    assert index.stat('/build.prop').sha256 is not None
+  assert os.stat(image + Ext4Index.SUFFIX).st_mtime_ns != built
+
+
+def test_extents(image, tmp_path):
+  with Ext4Index(image).open() as index:
+    assert len(index.extents('/fragmented.bin')) == 8
+    assert index.extents('/build.prop') == [(0, index.extents('/build.prop')[0][1], 1)]
+    assert index.extents('/zero.bin') == []
+    assert index.extents('/etc') is None
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from ext4_info import ExternalSort, FsFetures, ReadExt4
+
+
+def tune2fs_list(image):
+  tune2fs = shutil.which('tune2fs')
+  if tune2fs is None:
+    pytest.skip('tune2fs is needed to compare with')
+  # without the "tune2fs <version> (<date>)" banner
+  output = subprocess.run([tune2fs, '-l', image], check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+  return output.splitlines()[1:]
+
+
+@pytest.mark.parametrize('options', [
+  [],
+  # optional lines: name, check interval, mount counts, reserved owner
+  ['-L', 'system', '-c', '20', '-C', '3', '-i', '2w', '-e', 'panic', '-u', '1000', '-g', '1000'],
+  ['-O', '^has_journal,^metadata_csum', '-E', 'stride=4,stripe_width=8'],
+])
+def test_features_match_tune2fs(image, options):
+  if options:
+    subprocess.run([shutil.which('tune2fs')] + options + [image], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  assert FsFetures.from_image(image).lines() == tune2fs_list(image)
+
+
+def test_features_file(image, tmp_path):
+  ReadExt4(image, str(tmp_path)).read_ext4()
+  with open(tmp_path / 'sys_file_features.txt') as file:
+    lines = file.read().splitlines()
+
+  fields = dict(line.split(':', 1) for line in lines)
+  assert fields['Filesystem magic number'].strip() == '0xEF53'
+  assert fields['Block size'].strip() == '4096'
+  assert 'extent' in fields['Filesystem features'].split()
+  assert int(fields['Partition size']) == os.stat(image).st_size
+  assert lines[:-1] == FsFetures.from_image(image).lines()
+
+
+def test_external_sort_spills_runs():
+  lines = ['/system/app/Foo{0:d} 0 0 0644'.format(idx) for idx in range(50)] + [
+    '/system/a b', '/system/\u00e9t\u00e9', '/system/bad\udcff', '/system/new\nline', '']
+  random.Random(0).shuffle(lines)
+
+  sorter = ExternalSort(run_size=4)
+  for line in lines:
+    sorter.add(line)
+  assert len(sorter.runs) == len(lines) // 4
+  assert len(sorter.lines) < 4
+  assert list(sorter.sorted()) == sorted(lines)
+
+
+def test_external_sort_in_memory():
+  sorter = ExternalSort()
+  for line in ['b', 'c', 'a']:
+    sorter.add(line)
+  assert not sorter.runs
+  assert list(sorter.sorted()) == ['a', 'b', 'c']
+
+
+def test_spilled_info_is_identical(image, tmp_path, monkeypatch):
+  os.makedirs(tmp_path / 'memory')
+  ReadExt4(image, str(tmp_path / 'memory')).read_ext4()
+  # every line of config and contexts goes through a spilled run
+  monkeypatch.setattr(ExternalSort.__init__, '__defaults__', (2,))
+  os.makedirs(tmp_path / 'spilled')
+  ReadExt4(image, str(tmp_path / 'spilled')).read_ext4()
+
+  for name in ('sys_file_config.txt', 'sys_file_contexts.txt'):
+    with open(tmp_path / 'memory' / name) as memory, open(tmp_path / 'spilled' / name) as spilled:
+      assert memory.read() == spilled.read()
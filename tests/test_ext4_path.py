@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import stat
+
+import pytest
+
+import ext4
+from ext4_path import Ext4Path
+
+
+@pytest.fixture
+def root(image):
+  with open(image, 'rb') as file, ext4.Volume(file) as volume:
+    yield Ext4Path(volume)
+
+
+def test_pure_path(root):
+  path = root / 'app' / 'Foo' / 'Foo.apk'
+  assert str(path) == '/app/Foo/Foo.apk'
+  assert path.parts == ('/', 'app', 'Foo', 'Foo.apk')
+  assert (path.name, path.stem, path.suffix) == ('Foo.apk', 'Foo', '.apk')
+  assert path.parent == root / 'app/Foo'
+  assert root / 'etc' / '..' / 'build.prop' == root / 'build.prop'
+
+
+def test_read(root, tmp_path):
+  assert (root / 'build.prop').read_text() == 'ro.build.id=TEST\n'
+  assert (root / 'app/Foo/Foo.apk').read_bytes() == (tmp_path / 'src/app/Foo/Foo.apk').read_bytes()
+  with (root / 'sparse.bin').open('rb') as file:
+    file.seek(1 << 20)
+    assert file.read() == b'end'
+  with pytest.raises(IsADirectoryError):
+    (root / 'etc').open()
+  with pytest.raises(ValueError):
+    (root / 'build.prop').open('w')
+
+
+def test_stat(root):
+  assert (root / 'etc').is_dir() and not (root / 'etc').is_file()
+  assert (root / 'build.prop').stat().st_size == len('ro.build.id=TEST\n')
+  # hardlinks share an inode
+  assert (root / 'etc/build.prop').stat().st_ino == (root / 'build.prop').stat().st_ino
+  assert (root / 'build.prop').stat().st_nlink == 2
+  assert not (root / 'missing').exists()
+  with pytest.raises(FileNotFoundError):
+    (root / 'missing').stat()
+  with pytest.raises(NotADirectoryError):
+    (root / 'build.prop' / 'x').stat()
+
+
+def test_symlinks(root):
+  link = root / 'etc' / 'default.prop'
+  assert link.is_symlink() and link.is_file()
+  assert stat.S_ISLNK(link.lstat().st_mode)
+  assert link.readlink() == '../build.prop'
+  assert link.read_text() == 'ro.build.id=TEST\n'
+
+  # absolute targets resolve from the image root, where /system is missing
+  dangling = root / 'etc' / 'prop'
+  assert dangling.is_symlink() and not dangling.exists()
+  assert dangling.readlink() == '/system/build.prop'
+  with pytest.raises(OSError):
+    (root / 'build.prop').readlink()
+
+
+def test_iterdir_and_glob(root):
+  assert sorted(path.name for path in (root / 'etc').iterdir()) == \
+    ['build.prop', 'default.prop', 'prop', 'selinux']
+  assert [str(path) for path in root.glob('app/*/*.apk')] == ['/app/Foo/Foo.apk']
+  assert sorted(str(path) for path in root.rglob('*.prop')) == \
+    ['/build.prop', '/etc/build.prop', '/etc/default.prop']
+  assert [str(path) for path in root.glob('etc/selinux')] == ['/etc/selinux']
+  with pytest.raises(ValueError):
+    list(root.glob(''))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import ext4
+from ext4_index import Ext4Index
+
+from conftest import tree
+from extract_ext4 import ExtractExt4, PathMatcher, load_path_list, parser
+
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_extract(image, tmp_path, use_mmap):
+  out_dir = tmp_path / 'out'
+  os.makedirs(out_dir)
+  ExtractExt4(image, str(out_dir), use_mmap=use_mmap).extract_ext4()
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+
+
+def test_no_mmap_option():
+  assert parser().parse_args(['sys.img', 'out']).use_mmap
+  assert not parser().parse_args(['sys.img', 'out', '--no-mmap']).use_mmap
+
+
+def test_full_extraction_loads_inode_tables(image, tmp_path, monkeypatch):
+  loaded = []
+  load_inode_tables = ext4.Volume.load_inode_tables
+  monkeypatch.setattr(ext4.Volume, 'load_inode_tables',
+                      lambda volume: loaded.append(volume) or load_inode_tables(volume))
+  get_raw_inode = ext4.InodeTable.get_raw_inode
+  decoded = []
+  monkeypatch.setattr(ext4.InodeTable, 'get_raw_inode',
+                      lambda table, idx: decoded.append(idx) or get_raw_inode(table, idx))
+
+  out_dir = tmp_path / 'out'
+  os.makedirs(out_dir)
+  ExtractExt4(image, str(out_dir)).extract_ext4()
+  assert len(loaded) == 1
+  assert len(decoded) >= len(tree(str(out_dir)))
+
+
+def test_thread_pool_reads_with_pread(image, tmp_path):
+  out_dir = tmp_path / 'out'  # created by extract_ext4()
+  extractor = ExtractExt4(image, str(out_dir), workers=4)
+  assert not extractor.use_mmap
+  assert ExtractExt4(image, str(out_dir), workers=4, order='physical').use_mmap
+  extractor.extract_ext4()
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_unchanged_files_are_counted(image, tmp_path, workers):
+  out_dir = tmp_path / 'out'
+  manifest = str(tmp_path / 'manifest.jsonl')
+  ExtractExt4(image, str(out_dir), workers=workers, manifest=manifest).extract_ext4()
+
+  # same content, but no longer as recorded: compared instead of trusted
+  os.utime(out_dir / 'build.prop', ns=(0, 0))
+  extractor = ExtractExt4(image, str(out_dir), workers=workers, manifest=manifest)
+  extractor.extract_ext4()
+  assert extractor.num_unchanged == extractor.num_files - extractor.num_hardlinks
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+
+
+@pytest.mark.parametrize('primitives', ['copy_file_range', 'sendfile', 'pread'])
+def test_zero_copy(image, tmp_path, monkeypatch, primitives):
+  if primitives != 'copy_file_range':
+    monkeypatch.setattr(ext4, '_copy_file_range', None)
+  if primitives == 'pread':
+    monkeypatch.setattr(ext4, '_sendfile', None)
+  out_dir = tmp_path / 'out'
+  ExtractExt4(image, str(out_dir), zero_copy=True).extract_ext4()
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+  # holes are left unwritten
+  assert os.stat(out_dir / 'sparse.bin').st_blocks * 512 < os.stat(out_dir / 'sparse.bin').st_size
+
+
+@pytest.mark.parametrize('zero_copy', [False, True])
+def test_physical_order(image, tmp_path, zero_copy):
+  out_dir = tmp_path / 'out'
+  ExtractExt4(image, str(out_dir), order='physical', zero_copy=zero_copy).extract_ext4()
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+
+
+def test_physical_order_reads_forward(image, tmp_path, monkeypatch):
+  offsets = []
+  copy_fd_range = ext4.copy_fd_range
+  monkeypatch.setattr(ext4, 'copy_fd_range',
+                      lambda src_fd, src_offset, *args: offsets.append(src_offset) or
+                      copy_fd_range(src_fd, src_offset, *args))
+
+  ExtractExt4(image, str(tmp_path / 'out'), order='physical', zero_copy=True).extract_ext4()
+  # the fragmented file alone has 8 extents
+  assert len(offsets) > 8 and offsets == sorted(offsets)
+
+
+def test_path_matcher():
+  match = PathMatcher(['etc/selinux', 'app/*/*.apk', '/build.prop'])
+  DIR, FILE = ext4.InodeType.DIRECTORY, ext4.InodeType.FILE
+  assert match('/etc', DIR)  # leads to etc/selinux
+  assert not match('/etc', FILE)
+  assert not match('/etc/prop', FILE)
+  assert match('/etc/selinux', DIR) and match('/etc/selinux/plat_file_contexts', FILE)
+  assert match('/app/Foo/Foo.apk', FILE) and not match('/app/Foo/Foo.odex', FILE)
+  assert match('/build.prop', FILE) and not match('/a+b.txt', FILE)
+
+
+def test_load_path_list(tmp_path):
+  (tmp_path / 'list').write_text('# system files\nbuild.prop\n\n  etc/selinux  \n')
+  assert load_path_list(str(tmp_path / 'list')) == ['build.prop', 'etc/selinux']
+
+
+def test_selective_extraction(image, tmp_path):
+  out_dir = tmp_path / 'out'
+  ExtractExt4(image, str(out_dir), patterns=['etc/selinux', 'app/*/*.apk']).extract_ext4()
+  assert sorted(tree(str(out_dir))) == ['app', 'app/Foo', 'app/Foo/Foo.apk', 'etc', 'etc/selinux',
+                                        'etc/selinux/plat_file_contexts']
+  assert (out_dir / 'app' / 'Foo' / 'Foo.apk').read_bytes() == \
+    (tmp_path / 'src' / 'app' / 'Foo' / 'Foo.apk').read_bytes()
+
+
+@pytest.mark.parametrize('order', ['directory', 'physical'])
+@pytest.mark.parametrize('patterns', [None, ['etc/selinux', 'app/*/*.apk', 'fragmented.bin']])
+def test_index_planning(image, tmp_path, monkeypatch, order, patterns):
+  walked = tmp_path / 'walked'
+  ExtractExt4(image, str(walked), order=order, patterns=patterns).extract_ext4()
+  Ext4Index(image).open().close()
+
+  # the index replaces every directory read and, in physical order, the
+  # extent trees of the regular files
+  monkeypatch.setattr(ext4.Inode, 'open_dir', lambda *args: pytest.fail('directory read'))
+  open_read = ext4.Inode.open_read
+  opened = []
+  monkeypatch.setattr(ext4.Inode, 'open_read', lambda inode: opened.append(inode) or open_read(inode))
+
+  out_dir = tmp_path / 'out'
+  ExtractExt4(image, str(out_dir), order=order, patterns=patterns, use_index=True).extract_ext4()
+  assert tree(str(out_dir)) == tree(str(walked))
+  if order == 'physical':
+    assert not [inode for inode in opened if inode.is_file]
+
+
+@pytest.mark.parametrize('options', [{}, {'workers': 4}, {'order': 'physical'}, {'zero_copy': True}])
+def test_hardlinks(image, tmp_path, options):
+  out_dir = tmp_path / 'out'
+  extractor = ExtractExt4(image, str(out_dir), **options)
+  extractor.extract_ext4()
+  assert extractor.num_hardlinks == 1
+  assert os.stat(out_dir / 'etc' / 'build.prop').st_ino == os.stat(out_dir / 'build.prop').st_ino
+  assert (out_dir / 'etc' / 'build.prop').read_text() == 'ro.build.id=TEST\n'
+
+
+def test_hardlinks_replace_old_files(image, tmp_path):
+  out_dir = tmp_path / 'out'
+  manifest = str(tmp_path / 'manifest.jsonl')
+  ExtractExt4(image, str(out_dir), manifest=manifest).extract_ext4()
+  # a link broken since the last extraction is made again
+  os.remove(out_dir / 'etc' / 'build.prop')
+  (out_dir / 'etc' / 'build.prop').write_text('stale\n')
+  ExtractExt4(image, str(out_dir), manifest=manifest).extract_ext4()
+  assert os.stat(out_dir / 'etc' / 'build.prop').st_ino == os.stat(out_dir / 'build.prop').st_ino
+
+
+def test_entries_of_another_kind_are_replaced(image, tmp_path):
+  out_dir = tmp_path / 'out'
+  # left by an older image: a directory where a file is now, and the reverse
+  os.makedirs(out_dir / 'build.prop' / 'old')
+  os.makedirs(out_dir / 'etc' / 'default.prop')
+  (out_dir / 'app').write_text('old\n')
+  ExtractExt4(image, str(out_dir), manifest=str(tmp_path / 'manifest.jsonl')).extract_ext4()
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
+
+
+def test_manifest_removes_old_entries(image, tmp_path):
+  out_dir = tmp_path / 'out'
+  manifest = str(tmp_path / 'manifest.jsonl')
+  ExtractExt4(image, str(out_dir), manifest=manifest).extract_ext4()
+
+  # a newer image without app/
+  shutil.rmtree(tmp_path / 'src' / 'app')
+  newer = str(tmp_path / 'newer.img')
+  subprocess.run([shutil.which('mke2fs') or shutil.which('mkfs.ext4'), '-q', '-F', '-t', 'ext4',
+                  '-b', '4096', '-d', str(tmp_path / 'src'), newer, '16M'],
+                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  extractor = ExtractExt4(newer, str(out_dir), manifest=manifest)
+  extractor.extract_ext4()
+  assert extractor.num_removed == 3
+  assert tree(str(out_dir)) == tree(str(tmp_path / 'src'))
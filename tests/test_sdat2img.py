@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import subprocess
+
+import pytest
+
+import sdat2img
+
+from conftest import ROOT
+
+BLOCK = sdat2img.BLOCK_SIZE
+
+
+@pytest.fixture
+def sdat(tmp_path):
+  """
+  (transfer list, new.dat, expected image) of an image of 48 blocks whose
+  blocks 0-9 and 20-39 are new, 10-19 zero and 40-47 erased
+  """
+  image = bytearray(os.urandom(48 * BLOCK))
+  image[10 * BLOCK:20 * BLOCK] = bytes(10 * BLOCK)
+  image[40 * BLOCK:] = bytes(8 * BLOCK)
+
+  transfer_list = tmp_path / 'system.transfer.list'
+  transfer_list.write_text('4\n30\n0\n0\nnew 4,0,10,20,40\nzero 2,10,20\nerase 2,40,48\n')
+  new_dat = tmp_path / 'system.new.dat'
+  new_dat.write_bytes(bytes(image[:10 * BLOCK] + image[20 * BLOCK:40 * BLOCK]))
+  return str(transfer_list), str(new_dat), bytes(image)
+
+
+@pytest.fixture
+def brotli_tool():
+  brotli_tool = os.path.join(ROOT, 'bin', 'brotli')
+  if not os.access(brotli_tool, os.X_OK):
+    pytest.skip('bin/brotli is needed to make .br files')
+  return brotli_tool
+
+
+def compress(brotli_tool, new_dat, damage=None):
+  # new_dat + '.br', damage(compressed bytes) -> what to write instead
+  subprocess.run([brotli_tool, '-f', '-q', '5', new_dat], check=True)
+  if damage is not None:
+    with open(new_dat + '.br', 'rb') as file:
+      data = damage(file.read())
+    with open(new_dat + '.br', 'wb') as file:
+      file.write(data)
+  return new_dat + '.br'
+
+
+def truncate(data):
+  return data[:len(data) // 2]
+
+
+def corrupt(data):
+  # brotli has no checksum: damage the stream and meta-block headers
+  return bytes(b ^ 0xff for b in data[:4]) + data[4:]
+
+
+def convert(transfer_list, new_dat, output, brotli_tool='brotli', **kwargs):
+  with open(transfer_list) as transfer_list_file, \
+       sdat2img.open_new_dat(new_dat, brotli_tool) as new_dat_file:
+    sdat2img.main(transfer_list_file, new_dat_file, output, **kwargs)
+  with open(output, 'rb') as file:
+    return file.read()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_convert(sdat, tmp_path, monkeypatch, workers):
+  monkeypatch.setattr(sdat2img, 'CHUNK_SIZE', 4 * BLOCK)  # several chunks per range
+  transfer_list, new_dat, image = sdat
+  assert convert(transfer_list, new_dat, str(tmp_path / 'system.img'), workers=workers) == image
+
+
+def test_convert_stream(sdat, tmp_path):
+  transfer_list, new_dat, image = sdat
+  with open(transfer_list) as transfer_list_file, open(new_dat, 'rb') as file:
+    stream = io.BufferedReader(io.BytesIO(file.read()))
+    stream.seekable = lambda: False  # like a pipe
+    sdat2img.main(transfer_list_file, stream, str(tmp_path / 'system.img'))
+  with open(tmp_path / 'system.img', 'rb') as file:
+    assert file.read() == image
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_short_new_dat(sdat, tmp_path, workers):
+  transfer_list, new_dat, _ = sdat
+  with open(new_dat, 'r+b') as file:
+    file.truncate(25 * BLOCK)
+  with pytest.raises(ValueError):
+    convert(transfer_list, new_dat, str(tmp_path / 'system.img'), workers=workers)
+
+
+def test_convert_stream_short_writes(sdat, tmp_path, monkeypatch):
+  pwrite = os.pwrite
+  monkeypatch.setattr(os, 'pwrite', lambda fd, data, offset: pwrite(fd, data[:1000], offset))
+  test_convert_stream(sdat, tmp_path)
+
+
+@pytest.mark.parametrize('module', [True, False])
+def test_convert_brotli(sdat, tmp_path, monkeypatch, brotli_tool, module):
+  if module:
+    pytest.importorskip('brotli')
+  else:
+    monkeypatch.setattr(sdat2img, 'brotli', None)  # decoded by bin/brotli
+  transfer_list, new_dat, image = sdat
+  new_dat_br = compress(brotli_tool, new_dat)
+  assert convert(transfer_list, new_dat_br, str(tmp_path / 'system.img'), brotli_tool) == image
+
+
+@pytest.mark.parametrize('damage', [truncate, corrupt])
+@pytest.mark.parametrize('module', [True, False])
+def test_bad_brotli(sdat, tmp_path, monkeypatch, brotli_tool, module, damage):
+  if module:
+    pytest.importorskip('brotli')
+  else:
+    monkeypatch.setattr(sdat2img, 'brotli', None)
+  transfer_list, new_dat, _ = sdat
+  new_dat_br = compress(brotli_tool, new_dat, damage)
+  with pytest.raises(ValueError):
+    convert(transfer_list, new_dat_br, str(tmp_path / 'system.img'), brotli_tool)
+
+
+def test_brotli_output_is_bounded(tmp_path, brotli_tool):
+  if sdat2img.brotli is None:
+    pytest.skip('the brotli module (>= 1.1) is needed')
+  # 64 MiB of zeros compress to a few dozen bytes
+  zeros = tmp_path / 'system.new.dat'
+  with open(zeros, 'wb') as file:
+    file.truncate(64 << 20)
+  new_dat_br = compress(brotli_tool, str(zeros))
+
+  total = largest = 0
+  with open(new_dat_br, 'rb') as file:
+    reader = sdat2img.BrotliReader(file)
+    buffer = bytearray(sdat2img.STREAM_CHUNK_SIZE)
+    while True:
+      size = reader.readinto(buffer)
+      if not size:
+        break
+      assert not any(buffer[:size])
+      largest = max(largest, size + len(reader.buffer))
+      total += size
+
+  assert total == 64 << 20
+  assert largest <= 4 * sdat2img.STREAM_CHUNK_SIZE
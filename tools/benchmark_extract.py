@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Cold-cache timing of extract_ext4 with the -j/-z/--no-mmap combinations:
+#   python3 tools/benchmark_extract.py system.img /tmp/out [-r 5] [--drop-caches]
+# The image is evicted from the page cache before each run; --drop-caches
+# (root only) drops the whole page cache as well.
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin', 'python'))
+from extract_ext4 import ExtractExt4  # noqa: E402
+
+CASES = [
+  ('-j1', dict(workers=1)),
+  ('-j1 --no-mmap', dict(workers=1, use_mmap=False)),
+  ('-j4', dict(workers=4)),
+  ('-j8', dict(workers=8)),
+  ('-j1 -z', dict(workers=1, zero_copy=True)),
+  ('-j4 -z', dict(workers=4, zero_copy=True)),
+]
+
+
+def drop_caches(image, system_wide=False):
+  os.sync()
+  fd = os.open(image, os.O_RDONLY)
+  os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+  os.close(fd)
+  if system_wide:
+    with open('/proc/sys/vm/drop_caches', 'w') as file:
+      file.write('3')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Time extract_ext4 on a cold page cache')
+  parser.add_argument('image', help='ext4 image')
+  parser.add_argument('output', help='Scratch output directory (deleted before each run)')
+  parser.add_argument('-r', '--runs', type=int, default=5, help='Runs per case')
+  parser.add_argument('--drop-caches', dest='drop_caches', action='store_true',
+                      help='Drop the whole page cache before each run (needs root)')
+  args = parser.parse_args()
+
+  for label, options in CASES:
+    times = []
+    for _ in range(args.runs):
+      shutil.rmtree(args.output, ignore_errors=True)
+      drop_caches(args.image, args.drop_caches)
+      extractor = ExtractExt4(args.image, args.output, **options)
+      start = time.time()
+      with contextlib.redirect_stdout(io.StringIO()):
+        extractor.extract_ext4()
+      times.append(time.time() - start)
+    times.sort()
+    print(f'{label:16s} {"mmap" if extractor.use_mmap else "pread":5s} '
+          f'median {times[len(times) // 2]:.2f}s  min {times[0]:.2f}s')